@@ -0,0 +1,220 @@
+# coding: utf-8
+"""Build script for the optional lmdb._lmdb_cffi extension, which is used by
+lmdb.cffi_backend. Run it from the source tree to build the extension in place:
+
+	$ python lmdb/_cffi_build.py
+
+LMDB_INCLUDE_DIR and LMDB_LIB_DIR may point to the lmdb.h header and liblmdb if
+they are not installed in the default locations."""
+
+import os
+import shutil
+import tempfile
+
+import cffi
+
+# Handles and MDB_val pointers are passed as plain integers, so the extension can
+# operate on handles and ctypes structures which were created by the ctypes
+# backend and vice versa.
+CDEF = """
+typedef struct MDB_val {
+	size_t mv_size;
+	void *mv_data;
+} MDB_val;
+
+int lmdb_env_create(uintptr_t *env);
+int lmdb_txn_begin(uintptr_t env, uintptr_t parent, unsigned int flags,
+	uintptr_t *txn);
+uintptr_t lmdb_txn_env(uintptr_t txn);
+int lmdb_txn_commit(uintptr_t txn);
+void lmdb_txn_abort(uintptr_t txn);
+void lmdb_txn_reset(uintptr_t txn);
+int lmdb_txn_renew(uintptr_t txn);
+int lmdb_dbi_open(uintptr_t txn, const char *name, unsigned int flags,
+	unsigned int *dbi);
+int lmdb_dbi_flags(uintptr_t txn, unsigned int dbi, unsigned int *flags);
+int lmdb_stat(uintptr_t txn, unsigned int dbi, uintptr_t stat);
+int lmdb_drop(uintptr_t txn, unsigned int dbi, int del);
+int lmdb_get(uintptr_t txn, unsigned int dbi, uintptr_t key, uintptr_t data);
+int lmdb_get_bytes(uintptr_t txn, unsigned int dbi, const char *key,
+	size_t key_size, uintptr_t data);
+int lmdb_put(uintptr_t txn, unsigned int dbi, uintptr_t key, uintptr_t data,
+	unsigned int flags);
+int lmdb_put_bytes(uintptr_t txn, unsigned int dbi, const char *key,
+	size_t key_size, const char *data, size_t data_size, unsigned int flags);
+int lmdb_del(uintptr_t txn, unsigned int dbi, uintptr_t key, uintptr_t data);
+int lmdb_del_bytes(uintptr_t txn, unsigned int dbi, const char *key,
+	size_t key_size);
+int lmdb_cursor_open(uintptr_t txn, unsigned int dbi, uintptr_t *cursor);
+void lmdb_cursor_close(uintptr_t cursor);
+int lmdb_cursor_renew(uintptr_t txn, uintptr_t cursor);
+int lmdb_cursor_get(uintptr_t cursor, uintptr_t key, uintptr_t data, int op);
+int lmdb_cursor_put(uintptr_t cursor, uintptr_t key, uintptr_t data,
+	unsigned int flags);
+int lmdb_cursor_put_bytes(uintptr_t cursor, const char *key, size_t key_size,
+	const char *data, size_t data_size, unsigned int flags);
+int lmdb_cursor_del(uintptr_t cursor, unsigned int flags);
+"""
+
+SOURCE = """
+#include <stdint.h>
+#include <lmdb.h>
+
+#define TXN(txn) ((MDB_txn *)(txn))
+#define CURSOR(cursor) ((MDB_cursor *)(cursor))
+#define VAL(val) ((MDB_val *)(val))
+
+static int lmdb_env_create(uintptr_t *env)
+{
+	return mdb_env_create((MDB_env **)env);
+}
+
+static int lmdb_txn_begin(uintptr_t env, uintptr_t parent, unsigned int flags,
+	uintptr_t *txn)
+{
+	return mdb_txn_begin((MDB_env *)env, TXN(parent), flags, (MDB_txn **)txn);
+}
+
+static uintptr_t lmdb_txn_env(uintptr_t txn)
+{
+	return (uintptr_t)mdb_txn_env(TXN(txn));
+}
+
+static int lmdb_txn_commit(uintptr_t txn)
+{
+	return mdb_txn_commit(TXN(txn));
+}
+
+static void lmdb_txn_abort(uintptr_t txn)
+{
+	mdb_txn_abort(TXN(txn));
+}
+
+static void lmdb_txn_reset(uintptr_t txn)
+{
+	mdb_txn_reset(TXN(txn));
+}
+
+static int lmdb_txn_renew(uintptr_t txn)
+{
+	return mdb_txn_renew(TXN(txn));
+}
+
+static int lmdb_dbi_open(uintptr_t txn, const char *name, unsigned int flags,
+	unsigned int *dbi)
+{
+	return mdb_dbi_open(TXN(txn), name, flags, dbi);
+}
+
+static int lmdb_dbi_flags(uintptr_t txn, unsigned int dbi, unsigned int *flags)
+{
+	return mdb_dbi_flags(TXN(txn), dbi, flags);
+}
+
+static int lmdb_stat(uintptr_t txn, unsigned int dbi, uintptr_t stat)
+{
+	return mdb_stat(TXN(txn), dbi, (MDB_stat *)stat);
+}
+
+static int lmdb_drop(uintptr_t txn, unsigned int dbi, int del)
+{
+	return mdb_drop(TXN(txn), dbi, del);
+}
+
+static int lmdb_get(uintptr_t txn, unsigned int dbi, uintptr_t key,
+	uintptr_t data)
+{
+	return mdb_get(TXN(txn), dbi, VAL(key), VAL(data));
+}
+
+static int lmdb_get_bytes(uintptr_t txn, unsigned int dbi, const char *key,
+	size_t key_size, uintptr_t data)
+{
+	MDB_val k = {key_size, (void *)key};
+	return mdb_get(TXN(txn), dbi, &k, VAL(data));
+}
+
+static int lmdb_put(uintptr_t txn, unsigned int dbi, uintptr_t key,
+	uintptr_t data, unsigned int flags)
+{
+	return mdb_put(TXN(txn), dbi, VAL(key), VAL(data), flags);
+}
+
+static int lmdb_put_bytes(uintptr_t txn, unsigned int dbi, const char *key,
+	size_t key_size, const char *data, size_t data_size, unsigned int flags)
+{
+	MDB_val k = {key_size, (void *)key}, d = {data_size, (void *)data};
+	return mdb_put(TXN(txn), dbi, &k, &d, flags);
+}
+
+static int lmdb_del(uintptr_t txn, unsigned int dbi, uintptr_t key,
+	uintptr_t data)
+{
+	return mdb_del(TXN(txn), dbi, VAL(key), VAL(data));
+}
+
+static int lmdb_del_bytes(uintptr_t txn, unsigned int dbi, const char *key,
+	size_t key_size)
+{
+	MDB_val k = {key_size, (void *)key};
+	return mdb_del(TXN(txn), dbi, &k, NULL);
+}
+
+static int lmdb_cursor_open(uintptr_t txn, unsigned int dbi, uintptr_t *cursor)
+{
+	return mdb_cursor_open(TXN(txn), dbi, (MDB_cursor **)cursor);
+}
+
+static void lmdb_cursor_close(uintptr_t cursor)
+{
+	mdb_cursor_close(CURSOR(cursor));
+}
+
+static int lmdb_cursor_renew(uintptr_t txn, uintptr_t cursor)
+{
+	return mdb_cursor_renew(TXN(txn), CURSOR(cursor));
+}
+
+static int lmdb_cursor_get(uintptr_t cursor, uintptr_t key, uintptr_t data,
+	int op)
+{
+	return mdb_cursor_get(CURSOR(cursor), VAL(key), VAL(data), op);
+}
+
+static int lmdb_cursor_put(uintptr_t cursor, uintptr_t key, uintptr_t data,
+	unsigned int flags)
+{
+	return mdb_cursor_put(CURSOR(cursor), VAL(key), VAL(data), flags);
+}
+
+static int lmdb_cursor_put_bytes(uintptr_t cursor, const char *key,
+	size_t key_size, const char *data, size_t data_size, unsigned int flags)
+{
+	MDB_val k = {key_size, (void *)key}, d = {data_size, (void *)data};
+	return mdb_cursor_put(CURSOR(cursor), &k, &d, flags);
+}
+
+static int lmdb_cursor_del(uintptr_t cursor, unsigned int flags)
+{
+	return mdb_cursor_del(CURSOR(cursor), flags);
+}
+"""
+
+def _dirs(name):
+	path = os.environ.get(name)
+	return [path] if path else []
+
+ffibuilder = cffi.FFI()
+ffibuilder.cdef(CDEF)
+ffibuilder.set_source("lmdb._lmdb_cffi", SOURCE,
+	libraries=["lmdb"],
+	include_dirs=_dirs("LMDB_INCLUDE_DIR"),
+	library_dirs=_dirs("LMDB_LIB_DIR"),
+	runtime_library_dirs=_dirs("LMDB_LIB_DIR"))
+
+if __name__ == "__main__":
+	# Build in a temporary directory, so that only the extension module ends up
+	# in the package and not the generated C source and object files.
+	with tempfile.TemporaryDirectory() as tmpdir:
+		path = ffibuilder.compile(tmpdir=tmpdir, verbose=True)
+		shutil.copy(path, os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,267 @@
+# coding: utf-8
+"""Asynchronous variant of lmdb.web on top of aiohttp, which serves its index,
+key and transaction routes from a single event loop:
+
+	$ python -m aiohttp.web -P 8080 lmdb.aioweb:application
+
+Reads run on a bounded thread pool, or inline on the event loop if read_workers
+is 0. Writes are queued and run one after another by a single writer task in a
+dedicated thread, as LMDB allows only one write transaction at a time."""
+
+import asyncio
+import concurrent.futures
+import json
+import os
+import os.path
+
+import aiohttp.web
+import werkzeug.http
+
+import lmdb.lmdb as lmdb
+
+class Application(object):
+	"""Request handlers for an environment. The aiohttp application is available
+	as the app attribute."""
+
+	VERSION = "0.1"
+
+	def __init__(self, environment=None, name=None, path="./", read_workers=4,
+			max_pending_writes=1024):
+		if environment is None:
+			environment = lmdb.Environment(lmdb.lib)
+			environment.open(path)
+		self.environment = environment
+		self.name = "async" if name is None else name
+		self.read_workers = read_workers
+		self.max_pending_writes = max_pending_writes
+		self._read_executor = None
+		self._write_executor = None
+		self._writes = None
+		self._writer = None
+
+		self.app = aiohttp.web.Application()
+		self.app.on_startup.append(self._start)
+		self.app.on_cleanup.append(self._stop)
+		self.app.router.add_route("GET", "/", self.handle_index)
+		self.app.router.add_route("TRANSACTION", "/", self.handle_transaction)
+		# The C HTTP parser of aiohttp rejects unknown methods like TRANSACTION, so
+		# transactions are accepted as POST as well.
+		self.app.router.add_route("POST", "/", self.handle_transaction)
+		self.app.router.add_route("GET", "/{key:.+}", self.handle_get)
+		self.app.router.add_route("PUT", "/{key:.+}", self.handle_set)
+		self.app.router.add_route("DELETE", "/{key:.+}", self.handle_delete)
+
+	async def _start(self, app):
+		if self.read_workers:
+			self._read_executor = concurrent.futures.ThreadPoolExecutor(
+				self.read_workers, thread_name_prefix="lmdb-reader")
+		self._write_executor = concurrent.futures.ThreadPoolExecutor(1,
+			thread_name_prefix="lmdb-writer")
+		self._writes = asyncio.Queue(self.max_pending_writes)
+		self._writer = asyncio.ensure_future(self._run_writer())
+
+	async def _stop(self, app):
+		# Let the writer finish the queued writes and fail those queued after it
+		# stopped, so no caller waits forever.
+		await self._writes.put(None)
+		await self._writer
+		while not self._writes.empty():
+			_, future = self._writes.get_nowait()
+			if not future.done():
+				future.set_exception(RuntimeError("Application has been stopped"))
+		self._write_executor.shutdown()
+		if self._read_executor is not None:
+			self._read_executor.shutdown()
+
+	async def _run_writer(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			item = await self._writes.get()
+			if item is None:
+				return
+			func, future = item
+			if future.cancelled():
+				continue
+			try:
+				res = await loop.run_in_executor(self._write_executor,
+					self.environment.run, func)
+			except Exception as e:
+				if not future.done():
+					future.set_exception(e)
+			else:
+				if not future.done():
+					future.set_result(res)
+
+	async def read(self, func):
+		"""Call func with a read-only transaction and return its result."""
+		if self._read_executor is None:
+			return self.environment.run(func, write=False)
+		return await asyncio.get_running_loop().run_in_executor(
+			self._read_executor, self.environment.run, func, False)
+
+	async def write(self, func):
+		"""Call func with a write transaction of the writer task, commit it and
+		return the result of func."""
+		if self._writer is None or self._writer.done():
+			raise RuntimeError("Application isn't running")
+		future = asyncio.get_running_loop().create_future()
+		await self._writes.put((func, future))
+		if self._writer.done() and not future.done():
+			# Queued after _stop drained the queue.
+			future.set_exception(RuntimeError("Application has been stopped"))
+		return await future
+
+	def _pick_type(self, request, default="text/plain"):
+		if "Accept" in request.headers:
+			accepted = werkzeug.http.parse_accept_header(request.headers["Accept"])
+			return accepted.best_match([
+				"application/json",
+				"text/html",
+				"application/xml+xhtml",
+				"text/plain",
+				"application/octet-stream"
+			], accepted.best)
+		return default
+
+	def _json(self, obj, status=200):
+		return aiohttp.web.Response(text=json.dumps(obj), status=status,
+			content_type="application/json")
+
+	async def handle_index(self, request):
+		stat = self.environment.stat
+		envinfo = self.environment.info
+		return self._json({
+			"version": self.VERSION,
+			"name": self.name,
+			"mdb": {
+				"psize": stat.ms_psize,
+				"depth": stat.ms_depth,
+				"branch_pages": stat.ms_branch_pages,
+				"leaf_pages": stat.ms_leaf_pages,
+				"overflow_pages": stat.ms_overflow_pages,
+				"entries": stat.ms_entries
+			},
+			"env": {
+				"mapaddr": envinfo.me_mapaddr,
+				"mapsize": envinfo.me_mapsize,
+				"last_pgno": envinfo.me_last_pgno,
+				"last_txnid": envinfo.me_last_txnid,
+				"maxreaders": envinfo.me_maxreaders,
+				"numreaders": envinfo.me_numreaders
+			}
+		})
+
+	async def handle_get(self, request):
+		key = request.match_info["key"]
+		def get(txn):
+			return bytes(txn[key])
+		try:
+			data = await self.read(get)
+		except lmdb.Error as err:
+			return self._json(self._lmdb_error_to_json(err, key), 500)
+		except KeyError:
+			return self._json(self._key_error_to_json(key), 404)
+		res = aiohttp.web.Response(body=data)
+		res.headers["Content-Type"] = self._pick_type(request)
+		return res
+
+	async def handle_set(self, request):
+		key = request.match_info["key"]
+		value = await request.read()
+		def put(txn):
+			txn[key] = value
+		try:
+			await self.write(put)
+		except lmdb.Error as err:
+			return self._json(self._lmdb_error_to_json(err, key), 500)
+		return self._json({
+			"message": "success",
+			"success": "set",
+			"key": key
+		})
+
+	async def handle_delete(self, request):
+		key = request.match_info["key"]
+		def delete(txn):
+			del txn[key]
+		try:
+			await self.write(delete)
+		except lmdb.Error as err:
+			return self._json(self._lmdb_error_to_json(err, key), 500)
+		except KeyError:
+			return self._json(self._key_error_to_json(key), 404)
+		return self._json({
+			"message": "success",
+			"success": "delete",
+			"key": key
+		})
+
+	async def handle_transaction(self, request):
+		txn_info = json.loads(await request.text())
+		steps = txn_info.get("steps", [])
+		def run_steps(txn):
+			report = []
+			for step in steps:
+				try:
+					action = step["action"]
+					key = step["key"]
+				except KeyError:
+					report.append([None, None, "invalid", True])
+					txn.abort()
+					break
+				try:
+					if action == "contains":
+						if key not in txn:
+							raise KeyError(key)
+					elif action == "set":
+						txn[key] = step.get("value", b"")
+					elif action == "delete":
+						del txn[key]
+				except KeyError:
+					if step.get("abort", True):
+						report.append([action, key, "not_found", True])
+						txn.abort()
+						break
+					else:
+						report.append([action, key, "not_found", False])
+				report.append([action, key, "success", False])
+			return report
+		try:
+			if txn_info.get("write", False):
+				report = await self.write(run_steps)
+			else:
+				report = await self.read(run_steps)
+		except lmdb.Error as err:
+			return self._json(self._lmdb_error_to_json(err, None), 500)
+		return self._json({
+			"message": "success",
+			"success": "transaction",
+			"report": report
+		})
+
+	def _key_error_to_json(self, key):
+		return {
+			"message": "exception",
+			"exception": "not_found",
+			"key": key
+		}
+
+	def _lmdb_error_to_json(self, exc, key):
+		return {
+			"message": "exception",
+			"exception": "lmdb_error",
+			"errno": exc.code,
+			"msg": exc.message,
+			"key": key
+		}
+
+async def application(argv=None):
+	"""Return aiohttp application for the environment at LMDB_WEB_DBPATH. This is
+	the factory for python -m aiohttp.web and the aiohttp gunicorn worker."""
+	env = lmdb.Environment(lmdb.lib)
+	path = os.environ.get("LMDB_WEB_DBPATH", "./")
+	if os.path.isfile(path):
+		env.open(path, lmdb.MDB_NOSUBDIR)
+	else:
+		env.open(path)
+	return Application(environment=env).app
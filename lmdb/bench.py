@@ -0,0 +1,348 @@
+# coding: utf-8
+"""Benchmarks for point reads and writes, scans, bulk loads and the web API.
+
+	$ python -m lmdb.bench --json results.json
+	$ python -m lmdb.bench --compare results.json
+
+The cases are functions bench_<name>(benchmark, env, **params), which follow the
+protocol of the pytest-benchmark fixture: benchmark(func, *args) times func and
+returns its result, and benchmark.extra_info holds additional data. The runner
+in this module uses Benchmark as a stand-in and writes the results as JSON in
+the layout of pytest-benchmark, and tests/bench_lmdb.py runs the same cases
+with pytest-benchmark itself."""
+
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+import lmdb.lmdb as lmdb
+
+class Benchmark(object):
+	"""Stand-in for the pytest-benchmark fixture. Calling it with a function runs
+	the function in rounds of a calibrated number of iterations and records the
+	time per call in stats."""
+
+	def __init__(self, rounds=5, min_time=0.5):
+		self.rounds = rounds
+		self.min_time = min_time
+		self.stats = None
+		self.extra_info = {}
+
+	def __call__(self, func, *args, **kwargs):
+		iterations = 1
+		while True:
+			elapsed, res = self._time(iterations, func, args, kwargs)
+			if elapsed * self.rounds >= self.min_time or iterations >= 1 << 20:
+				break
+			iterations *= 2
+		timings = []
+		for _ in range(self.rounds):
+			elapsed, res = self._time(iterations, func, args, kwargs)
+			timings.append(elapsed / iterations)
+		mean = statistics.mean(timings)
+		self.stats = {
+			"min": min(timings),
+			"max": max(timings),
+			"mean": mean,
+			"median": statistics.median(timings),
+			"stddev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+			"rounds": self.rounds,
+			"iterations": iterations,
+			"ops": 1 / mean if mean else 0.0
+		}
+		return res
+
+	@staticmethod
+	def _time(iterations, func, args, kwargs):
+		res = None
+		start = time.perf_counter()
+		for _ in range(iterations):
+			res = func(*args, **kwargs)
+		return time.perf_counter() - start, res
+
+def make_keys(count, key_size):
+	"""Return sorted list of count distinct keys of key_size bytes."""
+	return [b"%0*d" % (key_size, i) for i in range(count)]
+
+def fill(env, count, key_size, value_size):
+	"""Load count items with values of value_size bytes into the environment and
+	return their keys."""
+	keys = make_keys(count, key_size)
+	value = b"x" * value_size
+	env.bulk_load(((key, value) for key in keys), presorted=True)
+	return keys
+
+def bench_env_getitem(benchmark, env, key_size, value_size, count=10000):
+	"""Environment.__getitem__, which runs a read transaction per lookup."""
+	keys = fill(env, count, key_size, value_size)
+	benchmark(env.__getitem__, keys[count // 2])
+
+def bench_txn_get(benchmark, env, key_size, value_size, count=10000,
+		lookups=1000):
+	"""Random lookups by Transaction.__getitem__ in one read transaction."""
+	keys = fill(env, count, key_size, value_size)
+	sample = random.Random(0).sample(keys, lookups)
+	def read():
+		with env.transaction(write=False) as txn:
+			for key in sample:
+				txn[key]
+	benchmark.extra_info["items"] = lookups
+	benchmark(read)
+
+def bench_txn_put(benchmark, env, key_size, value_size, count=1000):
+	"""Transaction.__setitem__ for count keys in one committed write
+	transaction."""
+	keys = make_keys(count, key_size)
+	value = b"x" * value_size
+	def write():
+		with env.transaction() as txn:
+			for key in keys:
+				txn[key] = value
+	benchmark.extra_info["items"] = count
+	benchmark(write)
+
+def bench_lib(benchmark, env, op, count=10000):
+	"""Single LibLMDB call on raw handles, without the Transaction and codec
+	layers: get, put, a cursor step (MDB_NEXT, wrapping around at the end) or
+	beginning and aborting a read transaction."""
+	lib = env._lib
+	keys = fill(env, count, 16, 64)
+	if op == "txn":
+		def begin_abort():
+			lib.txn_abort(lib.txn_begin(env._handle, None, lmdb.MDB_RDONLY))
+		benchmark(begin_abort)
+		return
+	txn = lib.txn_begin(env._handle, None, 0 if op == "put" else lmdb.MDB_RDONLY)
+	try:
+		dbi = lib.dbi_open(txn, None, 0)
+		if op == "get":
+			benchmark(lib.get, txn, dbi, keys[count // 2])
+		elif op == "put":
+			benchmark(lib.put, txn, dbi, keys[count // 2], b"y" * 64, 0)
+		else:
+			cursor = lib.cursor_open(txn, dbi)
+			key, data = lmdb.Value(), lmdb.Value()
+			def step():
+				try:
+					lib.cursor_get(cursor, key, data, lmdb.MDB_NEXT)
+				except lmdb.APIError:
+					lib.cursor_get(cursor, key, data, lmdb.MDB_FIRST)
+			try:
+				benchmark(step)
+			finally:
+				lib.cursor_close(cursor)
+	finally:
+		lib.txn_abort(txn)
+
+def bench_cursor_scan(benchmark, env, value_size, method, count=100000):
+	"""Full scan by iterating the items of a Cursor one by one (next) or with
+	iter_chunks, or only its keys or values."""
+	fill(env, count, 16, value_size)
+	def scan():
+		with env.transaction(write=False) as txn:
+			with closing(txn.primary_database.cursor()) as cursor:
+				if method == "next":
+					return sum(1 for _ in cursor)
+				elif method == "keys":
+					return sum(1 for _ in cursor.keys())
+				elif method == "values":
+					return sum(1 for _ in cursor.values())
+				return sum(len(chunk) for chunk in cursor.iter_chunks())
+	benchmark.extra_info["items"] = count
+	assert benchmark(scan) == count
+
+def bench_database_update(benchmark, env, value_size, count=10000):
+	"""Database.update with count new items in a write transaction, which is
+	aborted afterwards."""
+	value = b"x" * value_size
+	items = [(key, value) for key in make_keys(count, 16)]
+	def update():
+		txn = env.transaction()
+		try:
+			txn.primary_database.update(items)
+		finally:
+			txn.abort()
+	benchmark.extra_info["items"] = count
+	benchmark(update)
+
+def bench_put_many(benchmark, env, method, count=1000000, value_size=64):
+	"""count new items written by Database.put_many or by Database.put per item
+	in a write transaction, which is aborted afterwards."""
+	value = b"x" * value_size
+	items = [(key, value) for key in make_keys(count, 16)]
+	def write():
+		txn = env.transaction()
+		try:
+			db = txn.primary_database
+			if method == "put_many":
+				db.put_many(items)
+			else:
+				put = db.put
+				for key, value in items:
+					put(key, value)
+		finally:
+			txn.abort()
+	benchmark.extra_info["items"] = count
+	benchmark(write)
+
+def bench_web(benchmark, env, method, path, body=b"", value_size=1024):
+	"""Request to lmdb.web through the WSGI interface, without a server. The
+	environment is not instrumented."""
+	from lmdb.web import Application
+	app = Application(environment=env, name="bench", instrument=False)
+	fill(env, 1000, 16, value_size)
+	def request():
+		environ = {
+			"REQUEST_METHOD": method,
+			"PATH_INFO": path,
+			"SERVER_NAME": "localhost",
+			"SERVER_PORT": "80",
+			"wsgi.url_scheme": "http",
+			"wsgi.input": io.BytesIO(body),
+			"CONTENT_LENGTH": str(len(body))
+		}
+		status = []
+		res = b"".join(app(environ, lambda s, headers, exc_info=None: status.append(s)))
+		if not status[0].startswith("2"):
+			raise RuntimeError("{} {} failed with {}".format(method, path, status[0]))
+		return res
+	benchmark(request)
+
+SIZES = [(16, 64), (16, 1024), (64, 16384)]
+
+CASES = [("env_getitem", bench_env_getitem, dict(key_size=k, value_size=v))
+		for k, v in SIZES] + \
+	[("txn_get", bench_txn_get, dict(key_size=k, value_size=v))
+		for k, v in SIZES] + \
+	[("txn_put", bench_txn_put, dict(key_size=k, value_size=v))
+		for k, v in SIZES] + \
+	[("lib", bench_lib, dict(op=op)) for op in ("get", "put", "cursor", "txn")] + \
+	[("cursor_scan", bench_cursor_scan, dict(value_size=v, method=m))
+		for v in (64, 1024) for m in ("next", "chunks", "keys", "values")] + \
+	[("database_update", bench_database_update, dict(value_size=v))
+		for v in (64, 1024)] + \
+	[("put_many", bench_put_many, dict(method=m, count=1000000))
+		for m in ("put", "put_many")] + \
+	[("web", bench_web, dict(method="GET", path="/")),
+	("web", bench_web, dict(method="GET", path="/" + "0" * 15 + "1")),
+	("web", bench_web, dict(method="PUT", path="/bench", body=b"x" * 1024))]
+
+def case_name(name, params):
+	return "{}[{}]".format(name, "-".join(str(v) for k, v in
+		sorted(params.items()) if k != "body"))
+
+def run_case(lib, func, params, rounds=5, min_time=0.5):
+	"""Run a single case in a fresh environment and return the benchmark."""
+	path = tempfile.mkdtemp(prefix="lmdb-bench-")
+	try:
+		env = lmdb.Environment(lib, path)
+		env.set_mapsize(1 << 30)
+		try:
+			benchmark = Benchmark(rounds, min_time)
+			func(benchmark, env, **params)
+		finally:
+			env.close()
+	finally:
+		shutil.rmtree(path)
+	return benchmark
+
+def run(lib, pattern=None, rounds=5, min_time=0.5, count=None,
+		out=sys.stderr):
+	"""Run all cases whose name contains pattern and return the results in the
+	JSON layout of pytest-benchmark. count overrides the number of items of the
+	cases which have it as parameter."""
+	results = []
+	for name, func, params in CASES:
+		if count is not None and "count" in params:
+			params = dict(params, count=count)
+		full_name = case_name(name, params)
+		if pattern and pattern not in full_name:
+			continue
+		try:
+			benchmark = run_case(lib, func, params, rounds, min_time)
+		except ImportError as e:
+			print("{:40} skipped: {}".format(full_name, e), file=out)
+			continue
+		stats, extra_info = benchmark.stats, benchmark.extra_info
+		if "items" in extra_info:
+			extra_info["items_per_second"] = extra_info["items"] / stats["median"]
+		results.append({
+			"group": name,
+			"name": full_name,
+			"params": {k: v for k, v in params.items() if k != "body"},
+			"stats": stats,
+			"extra_info": extra_info
+		})
+		print("{:40} {:12.1f} us {:12.0f} ops/s".format(full_name,
+			stats["median"] * 1e6, extra_info.get("items_per_second", stats["ops"])),
+			file=out)
+	return {
+		"machine_info": {
+			"node": platform.node(),
+			"machine": platform.machine(),
+			"python_implementation": platform.python_implementation(),
+			"python_version": platform.python_version(),
+			"backend": type(lib).__name__,
+			"lmdb_version": lib.version()[3]
+		},
+		"datetime": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		"benchmarks": results
+	}
+
+def compare(old, new, tolerance):
+	"""Return list of (name, old median, new median) for benchmarks which are
+	more than tolerance slower in new than in old."""
+	old_medians = {b["name"]: b["stats"]["median"] for b in old["benchmarks"]}
+	return [(b["name"], old_medians[b["name"]], b["stats"]["median"])
+		for b in new["benchmarks"] if b["name"] in old_medians and
+			b["stats"]["median"] > old_medians[b["name"]] * (1 + tolerance)]
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="python -m lmdb.bench",
+		description=__doc__.splitlines()[0])
+	parser.add_argument("-k", dest="pattern",
+		help="only run benchmarks whose name contains PATTERN")
+	parser.add_argument("--json", metavar="PATH",
+		help="write results as JSON to PATH, or stdout if PATH is -")
+	parser.add_argument("--compare", metavar="PATH",
+		help="fail if a benchmark is slower than in the results in PATH")
+	parser.add_argument("--tolerance", type=float, default=0.2,
+		help="allowed slowdown for --compare (default: 0.2)")
+	parser.add_argument("--rounds", type=int, default=5)
+	parser.add_argument("--min-time", type=float, default=0.5,
+		help="minimum seconds spent per benchmark (default: 0.5)")
+	parser.add_argument("--count", type=int,
+		help="number of items for the bulk write cases (default: 1000000)")
+	parser.add_argument("--backend", choices=("ctypes", "cffi"),
+		help="LibLMDB backend, see lmdb.load_lib")
+	args = parser.parse_args(argv)
+
+	lib = lmdb.load_lib(args.backend or os.environ.get("LMDB_BACKEND"),
+		os.environ.get("LMDB_SO_PATH"))
+	results = run(lib, args.pattern, args.rounds, args.min_time, args.count)
+	if args.json == "-":
+		json.dump(results, sys.stdout, indent=2)
+	elif args.json:
+		with open(args.json, "w") as fh:
+			json.dump(results, fh, indent=2)
+	if args.compare:
+		with open(args.compare) as fh:
+			regressions = compare(json.load(fh), results, args.tolerance)
+		for name, old, new in regressions:
+			print("{}: {:.1f} us -> {:.1f} us".format(name, old * 1e6, new * 1e6),
+				file=sys.stderr)
+		return 1 if regressions else 0
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -0,0 +1,317 @@
+# coding: utf-8
+"""LibLMDB backend on top of the lmdb._lmdb_cffi extension, which is built by
+lmdb/_cffi_build.py. Importing this module raises ImportError if the extension
+has not been built."""
+
+import ctypes
+
+from lmdb._lmdb_cffi import ffi, lib as _clib
+from lmdb.lmdb import LibLMDB, Value, Stat, APIError, InvalidHandleError, \
+	MDB_NOTFOUND
+
+class CffiLibLMDB(LibLMDB):
+	"""LibLMDB which calls liblmdb through compiled cffi wrappers instead of
+	ctypes on all transaction, database and cursor operations. Handles are plain
+	integers, and Value arguments are passed by address. The remaining methods
+	use ctypes on the same library which the extension is linked against."""
+
+	def __init__(self):
+		# Symbol lookups through the handle of the extension find the liblmdb it is
+		# linked against, so both backends share one instance of the library.
+		import lmdb._lmdb_cffi
+		super().__init__(lmdb._lmdb_cffi.__file__)
+
+	@staticmethod
+	def _new_value():
+		"""Return MDB_val allocated by cffi and its address. Reading it is cheaper
+		than reading a ctypes Value, so the batch methods use it for results."""
+		val = ffi.new("MDB_val *")
+		return val, int(ffi.cast("uintptr_t", val))
+
+	@staticmethod
+	def _to_bytes(val):
+		return ffi.buffer(val.mv_data, val.mv_size)[:]
+
+	@staticmethod
+	def _to_buffer(val):
+		if not val.mv_size:
+			return memoryview(b"")
+		return memoryview(ffi.buffer(val.mv_data, val.mv_size)).toreadonly()
+
+	def _check(self, err):
+		if err != 0:
+			raise APIError(err, self.strerror(err))
+
+	def env_create(self):
+		"""Create new environment handle and return."""
+		res = ffi.new("uintptr_t *")
+		self._check(_clib.lmdb_env_create(res))
+		return res[0]
+
+	def txn_begin(self, env, parent, flags):
+		if env is None:
+			raise InvalidHandleError("txn_begin")
+		res = ffi.new("uintptr_t *")
+		self._check(_clib.lmdb_txn_begin(env, parent or 0, flags, res))
+		return res[0]
+
+	def txn_env(self, txn):
+		if txn is None:
+			raise InvalidHandleError("txn_env")
+		return _clib.lmdb_txn_env(txn)
+
+	def txn_commit(self, txn):
+		if txn is None:
+			raise InvalidHandleError("txn_commit")
+		self._check(_clib.lmdb_txn_commit(txn))
+
+	def txn_abort(self, txn):
+		if txn is None:
+			raise InvalidHandleError("txn_abort")
+		_clib.lmdb_txn_abort(txn)
+
+	def txn_reset(self, txn):
+		if txn is None:
+			raise InvalidHandleError("txn_reset")
+		_clib.lmdb_txn_reset(txn)
+
+	def txn_renew(self, txn):
+		if txn is None:
+			raise InvalidHandleError("txn_renew")
+		self._check(_clib.lmdb_txn_renew(txn))
+
+	def dbi_open(self, txn, name, flags):
+		if txn is None:
+			raise InvalidHandleError("dbi_open")
+		if isinstance(name, str):
+			name = name.encode()
+		res = ffi.new("unsigned int *")
+		self._check(_clib.lmdb_dbi_open(txn, ffi.NULL if name is None else name,
+			flags, res))
+		return res[0]
+
+	def stat(self, txn, dbi):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("stat")
+		res = Stat()
+		self._check(_clib.lmdb_stat(txn, dbi, ctypes.addressof(res)))
+		return res
+
+	def dbi_flags(self, txn, dbi):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("dbi_flags")
+		res = ffi.new("unsigned int *")
+		self._check(_clib.lmdb_dbi_flags(txn, dbi, res))
+		return ctypes.c_uint(res[0])
+
+	def drop(self, txn, dbi, delete=False):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("drop")
+		self._check(_clib.lmdb_drop(txn, dbi, delete))
+
+	def get(self, txn, dbi, key):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("get")
+		res = Value()
+		if type(key) is bytes:
+			err = _clib.lmdb_get_bytes(txn, dbi, key, len(key), ctypes.addressof(res))
+		else:
+			err = _clib.lmdb_get(txn, dbi, ctypes.addressof(key),
+				ctypes.addressof(res))
+		if err != 0:
+			raise APIError(err, self.strerror(err))
+		return res
+
+	def put(self, txn, dbi, key, value, flags):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("put")
+		if type(key) is bytes and type(value) is bytes:
+			err = _clib.lmdb_put_bytes(txn, dbi, key, len(key), value, len(value),
+				flags)
+		else:
+			if type(key) is bytes:
+				key = Value.from_bytes(key)
+			if type(value) is bytes:
+				value = Value.from_bytes(value)
+			err = _clib.lmdb_put(txn, dbi, ctypes.addressof(key),
+				ctypes.addressof(value), flags)
+		if err != 0:
+			raise APIError(err, self.strerror(err))
+
+	def delete(self, txn, dbi, key, value):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("delete")
+		if type(key) is bytes and value is None:
+			err = _clib.lmdb_del_bytes(txn, dbi, key, len(key))
+		else:
+			if type(key) is bytes:
+				key = Value.from_bytes(key)
+			err = _clib.lmdb_del(txn, dbi, ctypes.addressof(key),
+				0 if value is None else ctypes.addressof(value))
+		if err != 0:
+			raise APIError(err, self.strerror(err))
+
+	def get_many(self, txn, dbi, keys, default=None, buffers=False):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("get_many")
+		mdb_get = _clib.lmdb_get_bytes
+		res, res_addr = self._new_value()
+		convert = self._to_buffer if buffers else self._to_bytes
+		results = []
+		for k in keys:
+			if type(k) is not bytes:
+				k = bytes(k)
+			err = mdb_get(txn, dbi, k, len(k), res_addr)
+			if err == 0:
+				results.append(convert(res))
+			elif err == MDB_NOTFOUND:
+				results.append(default)
+			else:
+				raise APIError(err, self.strerror(err))
+		return results
+
+	def put_many(self, txn, dbi, items, flags):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("put_many")
+		mdb_put = _clib.lmdb_put_bytes
+		count = 0
+		for k, v in items:
+			if type(k) is not bytes:
+				k = bytes(k)
+			if type(v) is not bytes:
+				v = bytes(v)
+			err = mdb_put(txn, dbi, k, len(k), v, len(v), flags)
+			if err != 0:
+				raise APIError(err, self.strerror(err))
+			count += 1
+		return count
+
+	def delete_many(self, txn, dbi, keys):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("delete_many")
+		mdb_del = _clib.lmdb_del_bytes
+		count = 0
+		for k in keys:
+			if type(k) is not bytes:
+				k = bytes(k)
+			err = mdb_del(txn, dbi, k, len(k))
+			if err == 0:
+				count += 1
+			elif err != MDB_NOTFOUND:
+				raise APIError(err, self.strerror(err))
+		return count
+
+	def get_rows(self, txn, dbi, keys, address, row_size):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("get_rows")
+		mdb_get, memmove = _clib.lmdb_get_bytes, ffi.memmove
+		res, res_addr = self._new_value()
+		missing = []
+		for i, k in enumerate(keys):
+			if type(k) is not bytes:
+				k = bytes(k)
+			err = mdb_get(txn, dbi, k, len(k), res_addr)
+			if err == 0:
+				if res.mv_size != row_size:
+					raise ValueError("Value of {} bytes doesn't fit row of {} bytes".format(
+						res.mv_size, row_size))
+				memmove(ffi.cast("char *", address + i * row_size), res.mv_data,
+					row_size)
+			elif err == MDB_NOTFOUND:
+				missing.append(i)
+			else:
+				raise APIError(err, self.strerror(err))
+		return missing
+
+	def put_rows(self, txn, dbi, keys, address, row_size, flags):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("put_rows")
+		mdb_put, cast = _clib.lmdb_put_bytes, ffi.cast
+		count = 0
+		for k in keys:
+			if type(k) is not bytes:
+				k = bytes(k)
+			err = mdb_put(txn, dbi, k, len(k), cast("char *", address), row_size,
+				flags)
+			if err != 0:
+				raise APIError(err, self.strerror(err))
+			address += row_size
+			count += 1
+		return count
+
+	def cursor_open(self, txn, dbi):
+		if txn is None or dbi is None:
+			raise InvalidHandleError("cursor_open")
+		res = ffi.new("uintptr_t *")
+		self._check(_clib.lmdb_cursor_open(txn, dbi, res))
+		return res[0]
+
+	def cursor_close(self, cursor):
+		if cursor is None:
+			raise InvalidHandleError("cursor_close")
+		_clib.lmdb_cursor_close(cursor)
+
+	def cursor_renew(self, txn, cursor):
+		if txn is None or cursor is None:
+			raise InvalidHandleError("cursor_renew")
+		self._check(_clib.lmdb_cursor_renew(txn, cursor))
+
+	def cursor_get(self, cursor, key, data, op):
+		if cursor is None:
+			raise InvalidHandleError("cursor_get")
+		err = _clib.lmdb_cursor_get(cursor, ctypes.addressof(key),
+			ctypes.addressof(data), op)
+		if err != 0:
+			raise APIError(err, self.strerror(err))
+		return key, data
+
+	def cursor_get_many(self, cursor, op, count, keys=True, values=True,
+			buffers=False):
+		if cursor is None:
+			raise InvalidHandleError("cursor_get_many")
+		mdb_cursor_get = _clib.lmdb_cursor_get
+		key, key_addr = self._new_value()
+		data, data_addr = self._new_value()
+		convert = self._to_buffer if buffers else self._to_bytes
+		results = []
+		append = results.append
+		for _ in range(count):
+			err = mdb_cursor_get(cursor, key_addr, data_addr, op)
+			if err == MDB_NOTFOUND:
+				break
+			elif err != 0:
+				raise APIError(err, self.strerror(err))
+			if keys and values:
+				append((convert(key), convert(data)))
+			elif keys:
+				append(convert(key))
+			else:
+				append(convert(data))
+		return results
+
+	def cursor_put(self, cursor, key, data, flags):
+		if cursor is None:
+			raise InvalidHandleError("cursor_put")
+		self._check(_clib.lmdb_cursor_put(cursor, ctypes.addressof(key),
+			ctypes.addressof(data), flags))
+
+	def cursor_put_many(self, cursor, items, flags):
+		if cursor is None:
+			raise InvalidHandleError("cursor_put_many")
+		mdb_cursor_put = _clib.lmdb_cursor_put_bytes
+		count = 0
+		for k, v in items:
+			if type(k) is not bytes:
+				k = bytes(k)
+			if type(v) is not bytes:
+				v = bytes(v)
+			err = mdb_cursor_put(cursor, k, len(k), v, len(v), flags)
+			if err != 0:
+				raise APIError(err, self.strerror(err))
+			count += 1
+		return count
+
+	def cursor_del(self, cursor, flags):
+		if cursor is None:
+			raise InvalidHandleError("cursor_del")
+		self._check(_clib.lmdb_cursor_del(cursor, flags))
@@ -0,0 +1,289 @@
+# coding: utf-8
+
+import itertools
+import pickle
+import struct
+
+__all__ = ["Codec", "RawCodec", "Utf8Codec", "PickleCodec", "StructCodec",
+	"NumpyCodec", "ObjectCodec", "IntegerCodec", "TupleCodec", "object_to_bytes",
+	"encode_items"]
+
+def object_to_bytes(obj):
+	"""Convert object to bytes in the same way as Value.from_object."""
+	if isinstance(obj, bytes):
+		return obj
+	elif isinstance(obj, str):
+		return obj.encode()
+	elif isinstance(obj, (bytearray, memoryview)):
+		return bytes(obj)
+	return pickle.dumps(obj)
+
+class Codec(object):
+	"""Codecs convert between Python objects and the bytes which are stored as
+	keys or values in a database."""
+
+	def encode(self, obj):
+		"""Return bytes-like object for obj."""
+		raise NotImplementedError()
+
+	def decode(self, buf):
+		"""Return object for bytes or memoryview object buf."""
+		raise NotImplementedError()
+
+	def encode_many(self, objs):
+		"""Return list of bytes-like objects for a sequence of objects."""
+		return [self.encode(obj) for obj in objs]
+
+	def decode_many(self, bufs):
+		"""Return list of objects for a sequence of bytes or memoryview objects."""
+		return [self.decode(buf) for buf in bufs]
+
+	def sort_key(self, buf):
+		"""Return object for encoded buf which orders like buf in the database."""
+		return bytes(buf)
+
+class RawCodec(Codec):
+	"""Codec which stores bytes-like objects as they are and rejects everything
+	else."""
+
+	def encode(self, obj):
+		if not isinstance(obj, (bytes, bytearray, memoryview)):
+			raise TypeError("Expected bytes-like object, got {}".format(type(obj)))
+		return obj
+
+	def decode(self, buf):
+		return buf
+
+	def decode_many(self, bufs):
+		return list(bufs)
+
+class Utf8Codec(Codec):
+	"""Codec for str objects, which are stored UTF-8 encoded. The order of the
+	encoded strings equals the order of their code points."""
+
+	def encode(self, obj):
+		return obj.encode("utf-8")
+
+	def decode(self, buf):
+		return str(buf, "utf-8")
+
+class PickleCodec(Codec):
+	"""Codec which pickles every object and unpickles it on decoding."""
+
+	def __init__(self, protocol=pickle.HIGHEST_PROTOCOL):
+		self.protocol = protocol
+
+	def encode(self, obj):
+		return pickle.dumps(obj, self.protocol)
+
+	def decode(self, buf):
+		return pickle.loads(buf)
+
+class StructCodec(Codec):
+	"""Codec for fixed-size records described by a struct format, which stores
+	them without any framing. Records with a single field are encoded from and
+	decoded to plain values, all others from and to tuples."""
+
+	def __init__(self, format):
+		self._struct = struct.Struct(format)
+		self.size = self._struct.size
+		self._single = len(self._struct.unpack(bytes(self.size))) == 1
+
+	def encode(self, obj):
+		if self._single:
+			return self._struct.pack(obj)
+		return self._struct.pack(*obj)
+
+	def decode(self, buf):
+		res = self._struct.unpack(buf)
+		return res[0] if self._single else res
+
+	def decode_many(self, bufs):
+		unpack = self._struct.unpack
+		if self._single:
+			return [unpack(buf)[0] for buf in bufs]
+		return [unpack(buf) for buf in bufs]
+
+class NumpyCodec(Codec):
+	"""Codec for NumPy arrays of a fixed dtype and optionally a fixed shape, which
+	are stored as raw C-ordered data. Decoding buffers yields arrays which share
+	the memory of the buffer. This requires NumPy."""
+
+	def __init__(self, dtype, shape=None):
+		import numpy
+		self._numpy = numpy
+		self.dtype = numpy.dtype(dtype)
+		self.shape = shape
+
+	def encode(self, obj):
+		arr = self._numpy.ascontiguousarray(obj, dtype=self.dtype)
+		if self.shape is not None and arr.shape != tuple(self.shape):
+			raise ValueError("Expected array of shape {}, got {}".format(self.shape,
+				arr.shape))
+		return memoryview(arr).cast("B")
+
+	def decode(self, buf):
+		arr = self._numpy.frombuffer(buf, dtype=self.dtype)
+		if self.shape is not None:
+			arr = arr.reshape(self.shape)
+		return arr
+
+class ObjectCodec(Codec):
+	"""Default codec, which stores bytes-like objects as they are, str objects
+	UTF-8 encoded and pickles everything else. Decoding returns the stored
+	bytes."""
+
+	def encode(self, obj):
+		if isinstance(obj, (bytes, bytearray, memoryview)):
+			return obj
+		elif isinstance(obj, str):
+			return obj.encode()
+		return pickle.dumps(obj)
+
+	def encode_many(self, objs):
+		encode = self.encode
+		return [obj if type(obj) is bytes else encode(obj) for obj in objs]
+
+	def decode(self, buf):
+		return buf
+
+	def decode_many(self, bufs):
+		return list(bufs)
+
+class IntegerCodec(Codec):
+	"""Codec for MDB_INTEGERKEY and MDB_INTEGERDUP databases, which stores
+	unsigned integers in native byte order. The format is "N" for size_t or "I"
+	for unsigned int."""
+
+	def __init__(self, format="N"):
+		self._struct = struct.Struct(format)
+		self.size = self._struct.size
+
+	def encode(self, obj):
+		return self._struct.pack(obj)
+
+	def decode(self, buf):
+		return self._struct.unpack(buf)[0]
+
+	def decode_many(self, bufs):
+		unpack = self._struct.unpack
+		return [unpack(buf)[0] for buf in bufs]
+
+	sort_key = decode
+
+class TupleCodec(Codec):
+	"""Codec for tuples of None, bytes, str, int and float elements, whose encoding
+	sorts like the tuples themselves. Elements are compared by type first, in the
+	order above, so ints and floats don't interleave: (2,) sorts before (1.5,).
+	-0.0 is stored as 0.0. Every element encodes to a prefix of the encoding of
+	all tuples starting with it, so prefix scans over leading elements work on
+	the B-tree."""
+
+	NULL = 0x00
+	BYTES = 0x01
+	STRING = 0x02
+	NEG_BIG_INT = 0x0B
+	INT_ZERO = 0x14
+	POS_BIG_INT = 0x1D
+	FLOAT = 0x21
+
+	_double = struct.Struct(">d")
+	_uint64 = struct.Struct(">Q")
+
+	def encode(self, obj):
+		if not isinstance(obj, (tuple, list)):
+			raise TypeError("Expected tuple, got {}".format(type(obj)))
+		return b"".join(map(self._encode_element, obj))
+
+	def _encode_element(self, elem):
+		if elem is None:
+			return b"\x00"
+		elif isinstance(elem, (bytes, bytearray, memoryview)):
+			return b"\x01" + bytes(elem).replace(b"\x00", b"\x00\xff") + b"\x00"
+		elif isinstance(elem, str):
+			return (b"\x02" + elem.encode("utf-8").replace(b"\x00", b"\x00\xff")
+				+ b"\x00")
+		elif isinstance(elem, int):
+			return self._encode_int(elem)
+		elif isinstance(elem, float):
+			# -0.0 == 0.0, so both must encode the same.
+			bits = self._uint64.unpack(self._double.pack(elem or 0.0))[0]
+			# Flip the sign bit of positive and all bits of negative numbers, so
+			# the IEEE representation sorts bytewise.
+			bits ^= 0xFFFFFFFFFFFFFFFF if bits >> 63 else 1 << 63
+			return b"\x21" + self._uint64.pack(bits)
+		raise TypeError("Can't encode {} in tuple".format(type(elem)))
+
+	def _encode_int(self, value):
+		if value == 0:
+			return b"\x14"
+		size = (abs(value).bit_length() + 7) // 8
+		if size > 255:
+			raise ValueError("Integer too large to encode")
+		if value > 0:
+			data = value.to_bytes(size, "big")
+			if size <= 8:
+				return bytes((self.INT_ZERO + size,)) + data
+			return bytes((self.POS_BIG_INT, size)) + data
+		# Negative numbers are stored as one's complement of their magnitude, so
+		# larger magnitudes sort first.
+		data = ((1 << (size * 8)) - 1 + value).to_bytes(size, "big")
+		if size <= 8:
+			return bytes((self.INT_ZERO - size,)) + data
+		return bytes((self.NEG_BIG_INT, size ^ 0xFF)) + data
+
+	def decode(self, buf):
+		buf = bytes(buf)
+		res = []
+		pos = 0
+		while pos < len(buf):
+			elem, pos = self._decode_element(buf, pos)
+			res.append(elem)
+		return tuple(res)
+
+	def _decode_element(self, buf, pos):
+		code = buf[pos]
+		pos += 1
+		if code == self.NULL:
+			return None, pos
+		elif code in (self.BYTES, self.STRING):
+			end = pos
+			while True:
+				end = buf.index(b"\x00", end)
+				if buf[end + 1:end + 2] != b"\xff":
+					break
+				end += 2
+			data = buf[pos:end].replace(b"\x00\xff", b"\x00")
+			return data.decode("utf-8") if code == self.STRING else data, end + 1
+		elif self.INT_ZERO - 8 <= code <= self.INT_ZERO + 8:
+			size = code - self.INT_ZERO
+			if size >= 0:
+				return int.from_bytes(buf[pos:pos + size], "big"), pos + size
+			size = -size
+			value = int.from_bytes(buf[pos:pos + size], "big")
+			return value - (1 << (size * 8)) + 1, pos + size
+		elif code == self.POS_BIG_INT:
+			size = buf[pos]
+			pos += 1
+			return int.from_bytes(buf[pos:pos + size], "big"), pos + size
+		elif code == self.NEG_BIG_INT:
+			size = buf[pos] ^ 0xFF
+			pos += 1
+			value = int.from_bytes(buf[pos:pos + size], "big")
+			return value - (1 << (size * 8)) + 1, pos + size
+		elif code == self.FLOAT:
+			bits = self._uint64.unpack_from(buf, pos)[0]
+			bits ^= 1 << 63 if bits >> 63 else 0xFFFFFFFFFFFFFFFF
+			return self._double.unpack(self._uint64.pack(bits))[0], pos + 8
+		raise ValueError("Unknown type code {:#x} in tuple".format(code))
+
+def encode_items(items, key_codec, value_codec, chunk_size=1024):
+	"""Encode an iterable of (key, value) pairs in chunks with the batch methods
+	of the codecs and yield the encoded pairs."""
+	items = iter(items)
+	while True:
+		chunk = list(itertools.islice(items, chunk_size))
+		if not chunk:
+			return
+		keys, values = zip(*chunk)
+		yield from zip(key_codec.encode_many(keys), value_codec.encode_many(values))
@@ -6,9 +6,23 @@ import os
 import os.path
 import ctypes
 import ctypes.util
+import concurrent.futures
+import queue
+import threading
+import time
+import weakref
+import heapq
+import itertools
+import operator
+import struct
+import tempfile
+from contextlib import closing, contextmanager
+
+from lmdb.codec import *
 
 MDB_RDONLY = 0x20000
 MDB_NOSYNC = 0x10000
+MDB_NOMETASYNC = 0x40000
 MDB_NOSUBDIR = 0x4000
 MDB_FIXEDMAP = 0x01
 MDB_WRITEMAP = 0x80000
@@ -114,30 +128,126 @@ class EnvInfo(ctypes.Structure):
 		("me_maxreaders", ctypes.c_uint),
 		("me_numreaders", ctypes.c_uint)]
 
+# MDB_msg_func, which is called with each line of the output of mdb_reader_list
+MsgFunc = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_char_p, ctypes.c_void_p)
+
 class Value(ctypes.Structure):
 	_fields_ = [("mv_size", ctypes.c_size_t),
 		("mv_data", ctypes.c_void_p)]
 
 	def to_bytes(self):
 		return ctypes.string_at(self.mv_data, self.mv_size)
+
+	def to_buffer(self, readonly=True):
+		"""Return memoryview which aliases the data of this value instead of copying
+		it. The view is only valid as long as the memory it points to."""
+		if not self.mv_size:
+			return memoryview(b"")
+		buf = (ctypes.c_char * self.mv_size).from_address(self.mv_data)
+		buf = memoryview(buf).cast("B")
+		if readonly:
+			buf = buf.toreadonly()
+		return buf
 	
 	@classmethod
 	def from_bytes(cls, b):
+		"""Create value which points directly to the storage of the supplied
+		bytes-like object. The object is referenced by the value, so it stays alive
+		as long as the value does."""
 		self = cls()
-		self.mv_size = len(b)
-		self.mv_data = ctypes.cast(ctypes.create_string_buffer(b), ctypes.c_void_p)
+		if not isinstance(b, bytes):
+			view = memoryview(b)
+			if view.readonly or not view.c_contiguous:
+				# ctypes can't take the address of read-only buffers, so they have to
+				# be copied once.
+				b = view.tobytes()
+			else:
+				data = (ctypes.c_char * view.nbytes).from_buffer(view)
+				self.mv_size = view.nbytes
+		if isinstance(b, bytes):
+			data = ctypes.c_char_p(b)
+			self.mv_size = len(b)
+			# Read the address stored in the pointer, which is cheaper than a cast.
+			self.mv_data = ctypes.c_void_p.from_buffer(data).value
+		else:
+			self.mv_data = ctypes.addressof(data)
+		self._source = data
 		return self
 
 	@classmethod
 	def from_object(cls, obj):
 		if isinstance(obj, str):
 			obj = obj.encode()
-		elif isinstance(obj, bytes):
+		elif isinstance(obj, (bytes, bytearray, memoryview)):
 			pass
 		else:
 			obj = pickle.dumps(obj)
 		return cls.from_bytes(obj)
 
+class BytesValue(ctypes.Structure):
+	"""Variant of Value whose data field references a bytes object directly. It is
+	used by the batch methods of LibLMDB to reuse a single structure for many
+	items."""
+	_fields_ = [("mv_size", ctypes.c_size_t),
+		("mv_data", ctypes.c_char_p)]
+
+def prefix_successor(prefix):
+	"""Return the smallest key which is greater than all keys starting with
+	prefix, or None if there is no such key."""
+	prefix = prefix.rstrip(b"\xff")
+	if not prefix:
+		return None
+	return prefix[:-1] + bytes((prefix[-1] + 1,))
+
+_RUN_HEADER = struct.Struct("=II")
+
+def _write_run(items):
+	"""Write sorted list of bytes pairs to temporary file and return it."""
+	fh = tempfile.TemporaryFile()
+	pack = _RUN_HEADER.pack
+	for key, value in items:
+		fh.write(pack(len(key), len(value)))
+		fh.write(key)
+		fh.write(value)
+	fh.seek(0)
+	return fh
+
+def _read_run(fh):
+	"""Yield bytes pairs from run file written by _write_run."""
+	header_size, unpack = _RUN_HEADER.size, _RUN_HEADER.unpack
+	while True:
+		header = fh.read(header_size)
+		if not header:
+			break
+		key_size, value_size = unpack(header)
+		yield fh.read(key_size), fh.read(value_size)
+
+def sort_items(items, run_size=1000000, key=None):
+	"""Sort iterable of (key, value) bytes pairs by key in the default order of
+	LMDB, or by the result of key applied to the keys, and yield them. If there are
+	more than run_size items, sorted runs are written to temporary files and
+	merged afterwards, so the input doesn't have to fit into memory."""
+	if key is None:
+		by_key = operator.itemgetter(0)
+	else:
+		by_key = lambda item: key(item[0])
+	items = iter(items)
+	runs = []
+	try:
+		while True:
+			run = list(itertools.islice(items, run_size))
+			run.sort(key=by_key)
+			if len(run) < run_size:
+				break
+			runs.append(_write_run(run))
+		if not runs:
+			yield from run
+		else:
+			yield from heapq.merge(*map(_read_run, runs), run, key=by_key)
+	finally:
+		for fh in runs:
+			fh.close()
+
 class LibLMDB(object):
 	"""Instances of this class represents open shared library handles to a
 	liblmdb.so and enables access to it's low-level methods."""
@@ -154,6 +264,7 @@ class LibLMDB(object):
 		
 		self._lib = lib
 		self._monkey_patch_lib(lib)
+		self._bind_functions(lib)
 
 	@staticmethod
 	def _monkey_patch_lib(lib):
@@ -225,6 +336,10 @@ class LibLMDB(object):
 		lib.mdb_env_get_maxreaders.restype = ctypes.c_int
 		lib.mdb_env_get_maxreaders.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_uint)]
 
+		# mdb_reader_list
+		lib.mdb_reader_list.restype = ctypes.c_int
+		lib.mdb_reader_list.argtypes = [ctypes.c_void_p, MsgFunc, ctypes.c_void_p]
+
 		# mdb_env_set_maxdbs
 		lib.mdb_env_set_maxdbs.restype = ctypes.c_int
 		lib.mdb_env_set_maxdbs.argtypes = [ctypes.c_void_p, ctypes.c_uint]
@@ -323,13 +438,62 @@ class LibLMDB(object):
 		lib.mdb_cursor_del.restype = ctypes.c_int
 		lib.mdb_cursor_del.argtypes = [ctypes.c_void_p, ctypes.c_uint]
 
+	def _bind_functions(self, lib):
+		"""Cache the functions used on hot paths, so calling them doesn't go through
+		attribute lookups on the library object. Separate function pointers are
+		bound for passing BytesValue keys and values instead of Value."""
+
+		self._mdb_txn_begin = lib.mdb_txn_begin
+		self._mdb_txn_commit = lib.mdb_txn_commit
+		self._mdb_txn_abort = lib.mdb_txn_abort
+		self._mdb_txn_reset = lib.mdb_txn_reset
+		self._mdb_txn_renew = lib.mdb_txn_renew
+		self._mdb_get = lib.mdb_get
+		self._mdb_put = lib.mdb_put
+		self._mdb_del = lib.mdb_del
+		self._mdb_cursor_open = lib.mdb_cursor_open
+		self._mdb_cursor_close = lib.mdb_cursor_close
+		self._mdb_cursor_get = lib.mdb_cursor_get
+		self._mdb_cursor_put = lib.mdb_cursor_put
+
+		self._mdb_get_bytes = lib["mdb_get"]
+		self._mdb_get_bytes.restype = ctypes.c_int
+		self._mdb_get_bytes.argtypes = [ctypes.c_void_p, ctypes.c_uint,
+			ctypes.POINTER(BytesValue), ctypes.POINTER(Value)]
+
+		self._mdb_put_bytes = lib["mdb_put"]
+		self._mdb_put_bytes.restype = ctypes.c_int
+		self._mdb_put_bytes.argtypes = [ctypes.c_void_p, ctypes.c_uint,
+			ctypes.POINTER(BytesValue), ctypes.POINTER(BytesValue), ctypes.c_uint]
+
+		self._mdb_del_bytes = lib["mdb_del"]
+		self._mdb_del_bytes.restype = ctypes.c_int
+		self._mdb_del_bytes.argtypes = [ctypes.c_void_p, ctypes.c_uint,
+			ctypes.POINTER(BytesValue), ctypes.c_void_p]
+
+		self._mdb_put_rows = lib["mdb_put"]
+		self._mdb_put_rows.restype = ctypes.c_int
+		self._mdb_put_rows.argtypes = [ctypes.c_void_p, ctypes.c_uint,
+			ctypes.POINTER(BytesValue), ctypes.POINTER(Value), ctypes.c_uint]
+
+		self._mdb_cursor_put_bytes = lib["mdb_cursor_put"]
+		self._mdb_cursor_put_bytes.restype = ctypes.c_int
+		self._mdb_cursor_put_bytes.argtypes = [ctypes.c_void_p,
+			ctypes.POINTER(BytesValue), ctypes.POINTER(BytesValue), ctypes.c_uint]
+
+	def instrument(self, metrics=None):
+		"""Return proxy of this library which records its operations in metrics, see
+		lmdb.metrics.InstrumentedLibLMDB."""
+		from lmdb.metrics import InstrumentedLibLMDB
+		return InstrumentedLibLMDB(self, metrics)
+
 	def version(self):
 		"""Obtain version of MDB binding and return 4-tuple of major, minor, patch
 		level and version string."""
 		major, minor, patch = ctypes.c_int(), ctypes.c_int(), ctypes.c_int()
-		res = self._lib.mdb_version(ctypes.pointer(major),
-			ctypes.pointer(minor),
-			ctypes.pointer(patch)).decode()
+		res = self._lib.mdb_version(ctypes.byref(major),
+			ctypes.byref(minor),
+			ctypes.byref(patch)).decode()
 		return major.value, minor.value, patch.value, res
 
 	def strerror(self, errno):
@@ -339,7 +503,7 @@ class LibLMDB(object):
 	def env_create(self):
 		"""Create new environment handle and return."""
 		val = ctypes.c_void_p()
-		err = self._lib.mdb_env_create(ctypes.pointer(val))
+		err = self._lib.mdb_env_create(ctypes.byref(val))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return val
@@ -375,7 +539,7 @@ class LibLMDB(object):
 		if env is None:
 			raise InvalidHandleError("env_stat")
 		res = Stat()
-		err = self._lib.mdb_env_stat(env, ctypes.pointer(res))
+		err = self._lib.mdb_env_stat(env, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
@@ -385,7 +549,7 @@ class LibLMDB(object):
 		if env is None:
 			raise InvalidHandleError("env_info")
 		res = EnvInfo()
-		err = self._lib.mdb_env_info(env, ctypes.pointer(res))
+		err = self._lib.mdb_env_info(env, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
@@ -417,7 +581,7 @@ class LibLMDB(object):
 		if env is None:
 			raise InvalidHandleError("env_get_flags")
 		res = ctypes.c_uint()
-		err = self._lib.mdb_env_get_flags(env, ctypes.pointer(res))
+		err = self._lib.mdb_env_get_flags(env, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res.value
@@ -427,7 +591,7 @@ class LibLMDB(object):
 		if env is None:
 			raise InvalidHandleError("env_get_path")
 		res = ctypes.c_char_p()
-		err = self._lib.mdb_env_get_path(env, ctypes.pointer(res))
+		err = self._lib.mdb_env_get_path(env, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res.value.decode()
@@ -453,11 +617,32 @@ class LibLMDB(object):
 		if env is None:
 			raise InvalidHandleError("env_get_maxreaders")
 		res = ctypes.c_uint()
-		err = self._lib.mdb_env_get_maxreaders(env, ctypes.pointer(res))
+		err = self._lib.mdb_env_get_maxreaders(env, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res.value
 
+	def reader_list(self, env):
+		"""Return list of (pid, thread, txnid) tuples for the reader slots of the
+		environment which are in use by any process. txnid is None for slots whose
+		transaction is reset."""
+		if env is None:
+			raise InvalidHandleError("reader_list")
+		readers = []
+		def collect(msg, ctx):
+			# The first line is a header, followed by one line per slot or a note
+			# that there are no readers.
+			fields = msg.split()
+			if len(fields) == 3 and fields[0].isdigit():
+				txnid = fields[2]
+				readers.append((int(fields[0]), int(fields[1], 16),
+					None if txnid == b"-" else int(txnid)))
+			return 0
+		err = self._lib.mdb_reader_list(env, MsgFunc(collect), None)
+		if err < 0:
+			raise APIError(err, self.strerror(err))
+		return readers
+
 	def env_set_maxdbs(self, env, dbs):
 		"""Set maximum database count for environment handle."""
 		if env is None:
@@ -479,7 +664,7 @@ class LibLMDB(object):
 		if env is None:
 			raise InvalidHandleError("txn_begin")
 		res = ctypes.c_void_p()
-		err = self._lib.mdb_txn_begin(env, parent, flags, ctypes.pointer(res))
+		err = self._mdb_txn_begin(env, parent, flags, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
@@ -495,7 +680,7 @@ class LibLMDB(object):
 		"""Commit and invalidate transaction handle."""
 		if txn is None:
 			raise InvalidHandleError("txn_commit")
-		err = self._lib.mdb_txn_commit(txn)
+		err = self._mdb_txn_commit(txn)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 	
@@ -503,19 +688,19 @@ class LibLMDB(object):
 		"""Abort and invalidate transaction handle."""
 		if txn is None:
 			raise InvalidHandleError("txn_abort")
-		self._lib.mdb_txn_abort(txn)
+		self._mdb_txn_abort(txn)
 	
 	def txn_reset(self, txn):
 		"""Reset transaction handle."""
 		if txn is None:
 			raise InvalidHandleError("txn_reset")
-		self._lib.mdb_txn_reset(txn)
+		self._mdb_txn_reset(txn)
 	
 	def txn_renew(self, txn):
 		"""Prepare transaction handle for reuse after reset."""
 		if txn is None:
 			raise InvalidHandleError("txn_renew")
-		err = self._lib.mdb_txn_renew(txn)
+		err = self._mdb_txn_renew(txn)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 	
@@ -526,7 +711,7 @@ class LibLMDB(object):
 		if isinstance(name, str):
 			name = name.encode()
 		res = ctypes.c_uint()
-		err = self._lib.mdb_dbi_open(txn, name, flags, ctypes.pointer(res))
+		err = self._lib.mdb_dbi_open(txn, name, flags, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
@@ -536,7 +721,7 @@ class LibLMDB(object):
 		if txn is None or dbi is None:
 			raise InvalidHandleError("stat")
 		res = Stat()
-		err = self._lib.mdb_stat(txn, dbi, ctypes.pointer(res))
+		err = self._lib.mdb_stat(txn, dbi, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
@@ -546,16 +731,16 @@ class LibLMDB(object):
 		if txn is None or dbi is None:
 			raise InvalidHandleError("dbi_flags")
 		res = ctypes.c_uint()
-		err = self._lib.mdb_dbi_flags(txn, dbi, ctypes.pointer(res))
+		err = self._lib.mdb_dbi_flags(txn, dbi, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
 
-	def dbi_close(self, txn, dbi):
-		"""Close database handle."""
-		if txn is None or dbi is None:
+	def dbi_close(self, env, dbi):
+		"""Close database handle in environment."""
+		if env is None or dbi is None:
 			raise InvalidHandleError("dbi_close")
-		self._lib.mdb_dbi_close(txn, dbi)
+		self._lib.mdb_dbi_close(env, dbi)
 
 	def drop(self, txn, dbi, delete=False):
 		"""Empty database if delete is False or delete database from enviroment and
@@ -567,36 +752,187 @@ class LibLMDB(object):
 			raise APIError(err, self.strerror(err))
 
 	def get(self, txn, dbi, key):
-		"""Get items from database handle."""
+		"""Get item for a Value or bytes key from database handle and return it as
+		Value."""
 		if txn is None or dbi is None:
 			raise InvalidHandleError("get")
 		res = Value()
-		err = self._lib.mdb_get(txn, dbi, ctypes.pointer(key), ctypes.pointer(res))
+		if type(key) is bytes:
+			err = self._mdb_get_bytes(txn, dbi, BytesValue(len(key), key), res)
+		else:
+			err = self._mdb_get(txn, dbi, key, res)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
 
 	def put(self, txn, dbi, key, value, flags):
-		"""Put item into database."""
+		"""Put item with Value or bytes key and value into database."""
 		if txn is None or dbi is None:
 			raise InvalidHandleError("put")
-		err = self._lib.mdb_put(txn, dbi, ctypes.pointer(key), ctypes.pointer(value), flags)
+		if type(key) is bytes and type(value) is bytes:
+			err = self._mdb_put_bytes(txn, dbi, BytesValue(len(key), key),
+				BytesValue(len(value), value), flags)
+		else:
+			if type(key) is bytes:
+				key = Value.from_bytes(key)
+			if type(value) is bytes:
+				value = Value.from_bytes(value)
+			err = self._mdb_put(txn, dbi, key, value, flags)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 	
 	def delete(self, txn, dbi, key, value):
-		"""Delete item from database."""
+		"""Delete item with Value or bytes key, and optional value, from database."""
 		if txn is None or dbi is None:
 			raise InvalidHandleError("delete")
-		err = self._lib.mdb_del(txn, dbi, ctypes.pointer(key), None if value is None else ctypes.pointer(value))
+		if type(key) is bytes and value is None:
+			err = self._mdb_del_bytes(txn, dbi, BytesValue(len(key), key), None)
+		else:
+			if type(key) is bytes:
+				key = Value.from_bytes(key)
+			err = self._mdb_del(txn, dbi, key, value)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 	
+	def get_many(self, txn, dbi, keys, default=None, buffers=False):
+		"""Get items for an iterable of bytes-like keys from database handle and return
+		list of bytes, or memoryviews if buffers is True. Missing keys yield
+		default."""
+		if txn is None or dbi is None:
+			raise InvalidHandleError("get_many")
+		mdb_get, byref = self._mdb_get_bytes, ctypes.byref
+		key, res = BytesValue(), Value()
+		key_ref, res_ref = byref(key), byref(res)
+		convert = Value.to_buffer if buffers else Value.to_bytes
+		results = []
+		for k in keys:
+			if type(k) is not bytes:
+				k = bytes(k)
+			key.mv_size, key.mv_data = len(k), k
+			err = mdb_get(txn, dbi, key_ref, res_ref)
+			if err == 0:
+				results.append(convert(res))
+			elif err == MDB_NOTFOUND:
+				results.append(default)
+			else:
+				raise APIError(err, self.strerror(err))
+		return results
+
+	def put_many(self, txn, dbi, items, flags):
+		"""Put items from an iterable of bytes-like pairs into database and return
+		the number of items."""
+		if txn is None or dbi is None:
+			raise InvalidHandleError("put_many")
+		mdb_put, byref = self._mdb_put_bytes, ctypes.byref
+		key, value = BytesValue(), BytesValue()
+		key_ref, value_ref = byref(key), byref(value)
+		count = 0
+		for k, v in items:
+			if type(k) is not bytes:
+				k = bytes(k)
+			if type(v) is not bytes:
+				v = bytes(v)
+			key.mv_size, key.mv_data = len(k), k
+			value.mv_size, value.mv_data = len(v), v
+			err = mdb_put(txn, dbi, key_ref, value_ref, flags)
+			if err != 0:
+				raise APIError(err, self.strerror(err))
+			count += 1
+		return count
+
+	def delete_many(self, txn, dbi, keys):
+		"""Delete items for an iterable of bytes-like keys from database and return the
+		number of deleted items. Missing keys are skipped."""
+		if txn is None or dbi is None:
+			raise InvalidHandleError("delete_many")
+		mdb_del, byref = self._mdb_del_bytes, ctypes.byref
+		key = BytesValue()
+		key_ref = byref(key)
+		count = 0
+		for k in keys:
+			if type(k) is not bytes:
+				k = bytes(k)
+			key.mv_size, key.mv_data = len(k), k
+			err = mdb_del(txn, dbi, key_ref, None)
+			if err == 0:
+				count += 1
+			elif err != MDB_NOTFOUND:
+				raise APIError(err, self.strerror(err))
+		return count
+
+	def get_rows(self, txn, dbi, keys, address, row_size):
+		"""Copy the values for an iterable of bytes-like keys into consecutive rows of
+		row_size bytes starting at address and return the list of indices of missing
+		keys, whose rows are left untouched."""
+		if txn is None or dbi is None:
+			raise InvalidHandleError("get_rows")
+		mdb_get, byref, memmove = self._mdb_get_bytes, ctypes.byref, ctypes.memmove
+		key, res = BytesValue(), Value()
+		key_ref, res_ref = byref(key), byref(res)
+		missing = []
+		for i, k in enumerate(keys):
+			if type(k) is not bytes:
+				k = bytes(k)
+			key.mv_size, key.mv_data = len(k), k
+			err = mdb_get(txn, dbi, key_ref, res_ref)
+			if err == 0:
+				if res.mv_size != row_size:
+					raise ValueError("Value of {} bytes doesn't fit row of {} bytes".format(
+						res.mv_size, row_size))
+				memmove(address + i * row_size, res.mv_data, row_size)
+			elif err == MDB_NOTFOUND:
+				missing.append(i)
+			else:
+				raise APIError(err, self.strerror(err))
+		return missing
+
+	def put_rows(self, txn, dbi, keys, address, row_size, flags):
+		"""Put consecutive rows of row_size bytes starting at address as values for an
+		iterable of bytes-like keys and return the number of items."""
+		if txn is None or dbi is None:
+			raise InvalidHandleError("put_rows")
+		mdb_put, byref = self._mdb_put_rows, ctypes.byref
+		key, value = BytesValue(), Value(row_size, address)
+		key_ref, value_ref = byref(key), byref(value)
+		count = 0
+		for k in keys:
+			if type(k) is not bytes:
+				k = bytes(k)
+			key.mv_size, key.mv_data = len(k), k
+			err = mdb_put(txn, dbi, key_ref, value_ref, flags)
+			if err != 0:
+				raise APIError(err, self.strerror(err))
+			value.mv_data += row_size
+			count += 1
+		return count
+
+	def cursor_put_many(self, cursor, items, flags):
+		"""Put items from an iterable of bytes-like pairs by cursor and return the
+		number of items."""
+		if cursor is None:
+			raise InvalidHandleError("cursor_put_many")
+		mdb_cursor_put, byref = self._mdb_cursor_put_bytes, ctypes.byref
+		key, value = BytesValue(), BytesValue()
+		key_ref, value_ref = byref(key), byref(value)
+		count = 0
+		for k, v in items:
+			if type(k) is not bytes:
+				k = bytes(k)
+			if type(v) is not bytes:
+				v = bytes(v)
+			key.mv_size, key.mv_data = len(k), k
+			value.mv_size, value.mv_data = len(v), v
+			err = mdb_cursor_put(cursor, key_ref, value_ref, flags)
+			if err != 0:
+				raise APIError(err, self.strerror(err))
+			count += 1
+		return count
+
 	def cursor_open(self, txn, dbi):
 		if txn is None or dbi is None:
 			raise InvalidHandleError("cursor_open")
 		res = ctypes.c_void_p()
-		err = self._lib.mdb_cursor_open(txn, dbi, ctypes.pointer(res))
+		err = self._mdb_cursor_open(txn, dbi, ctypes.byref(res))
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return res
@@ -604,7 +940,7 @@ class LibLMDB(object):
 	def cursor_close(self, cursor):
 		if cursor is None:
 			raise InvalidHandleError("cursor_close")
-		self._lib.mdb_cursor_close(cursor)
+		self._mdb_cursor_close(cursor)
 
 	def cursor_renew(self, txn, cursor):
 		if txn is None or cursor is None:
@@ -616,15 +952,41 @@ class LibLMDB(object):
 	def cursor_get(self, cursor, key, data, op):
 		if cursor is None:
 			raise InvalidHandleError("cursor_get")
-		err = self._lib.mdb_cursor_get(cursor, key, data, op)
+		err = self._mdb_cursor_get(cursor, key, data, op)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 		return key, data
 
+	def cursor_get_many(self, cursor, op, count, keys=True, values=True,
+			buffers=False):
+		"""Move cursor by op up to count times and return list of (key, data)
+		pairs, or only keys or data if the other one is disabled. The list is
+		shorter than count if the cursor reached the end."""
+		if cursor is None:
+			raise InvalidHandleError("cursor_get_many")
+		mdb_cursor_get = self._mdb_cursor_get
+		key, data = Value(), Value()
+		convert = Value.to_buffer if buffers else Value.to_bytes
+		results = []
+		append = results.append
+		for _ in range(count):
+			err = mdb_cursor_get(cursor, key, data, op)
+			if err == MDB_NOTFOUND:
+				break
+			elif err != 0:
+				raise APIError(err, self.strerror(err))
+			if keys and values:
+				append((convert(key), convert(data)))
+			elif keys:
+				append(convert(key))
+			else:
+				append(convert(data))
+		return results
+
 	def cursor_put(self, cursor, key, data, flags):
 		if cursor is None:
 			raise InvalidHandleError("cursor_put")
-		err = self._lib.mdb_cursor_put(cursor, key, data, flags)
+		err = self._mdb_cursor_put(cursor, key, data, flags)
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 	
@@ -635,14 +997,98 @@ class LibLMDB(object):
 		if err != 0:
 			raise APIError(err, self.strerror(err))
 	
+class _ResizeLock(object):
+	"""Shared/exclusive lock which keeps the memory map from being remapped while
+	transactions of this process use it. Transactions hold it shared for their
+	lifetime, and resizing the map holds it exclusively. A thread which holds it
+	shared already may take it shared again while a resize is waiting, so
+	nested and concurrent transactions of one thread can't deadlock."""
+
+	def __init__(self):
+		self._cond = threading.Condition(threading.Lock())
+		self._local = threading.local()
+		self._active = 0
+		self._resizing = False
+
+	def _holder(self):
+		try:
+			return self._local.holder
+		except AttributeError:
+			holder = self._local.holder = [0]
+			return holder
+
+	def held(self):
+		"""Return True if the current thread holds the lock shared."""
+		return self._holder()[0] > 0
+
+	def acquire_shared(self):
+		"""Acquire the lock shared and return the token for release_shared."""
+		holder = self._holder()
+		with self._cond:
+			if not holder[0]:
+				while self._resizing:
+					self._cond.wait()
+			holder[0] += 1
+			self._active += 1
+		return holder
+
+	def release_shared(self, holder):
+		with self._cond:
+			holder[0] -= 1
+			self._active -= 1
+			if not self._active:
+				self._cond.notify_all()
+
+	@contextmanager
+	def exclusive(self, timeout=None):
+		"""Wait until no transaction is active and keep new ones from beginning.
+		Raise TimeoutError if that takes longer than timeout seconds. The current
+		thread must not hold the lock shared."""
+		deadline = None if timeout is None else time.monotonic() + timeout
+		def remaining():
+			return None if deadline is None else max(deadline - time.monotonic(), 0)
+		with self._cond:
+			if not self._cond.wait_for(lambda: not self._resizing, remaining()):
+				raise TimeoutError("Timed out waiting for another resize")
+			self._resizing = True
+			if not self._cond.wait_for(lambda: not self._active, remaining()):
+				self._resizing = False
+				self._cond.notify_all()
+				raise TimeoutError("Timed out waiting for transactions to end")
+		try:
+			yield
+		finally:
+			with self._cond:
+				self._resizing = False
+				self._cond.notify_all()
+
+class _ThreadToken(object):
+	"""Object stored in a thread-local, whose finalizer runs when the thread
+	exits."""
+
 class Environment(object):
 	"""Instances of this class represents an environment handle and provide higher
 	level access to it's properties."""
 
 	_handle = None
-
-	def __init__(self, lib, path=None, flags=None, mode=None):
+	max_spare_txns = 1
+	grow_factor = None
+	grow_limit = None
+	grow_retries = 4
+	grow_timeout = 10.0
+
+	def __init__(self, lib, path=None, flags=None, mode=None, buffers=False,
+			key_codec=None, value_codec=None):
 		self._lib = lib
+		self.buffers = buffers
+		self.key_codec = key_codec
+		self.value_codec = value_codec
+		self._databases = {}
+		self._codecs = {}
+		self._spare_txns = threading.local()
+		self._spare_txn_pools = {}
+		self._spare_txn_lock = threading.Lock()
+		self._resize_lock = _ResizeLock()
 		self.create()
 		if path is not None:
 			self.open(path, flags, mode)
@@ -666,11 +1112,13 @@ class Environment(object):
 	def close(self):
 		"""Close environment handle. You have to recreate an environment handle."""
 		try:
+			self._abort_spare_txns()
 			self._lib.env_close(self._handle)
 		except InvalidHandleError:
 			pass
 		finally:
 			self._handle = None
+			self._databases.clear()
 
 	def copy(self, path):
 		self._lib.env_copy(self._handle, path)
@@ -707,6 +1155,77 @@ class Environment(object):
 	def set_mapsize(self, size):
 		"""Set mapping size of this environment."""
 		self._lib.env_set_mapsize(self._handle, size)
+
+	def set_autogrow(self, factor=2.0, limit=None, retries=4, timeout=10.0):
+		"""Grow the map by factor, up to limit bytes, when a write transaction run
+		by this environment fails with MDB_MAP_FULL, and retry it up to retries
+		times. A factor of None disables growing.
+
+		Growing waits until all transactions of this process have ended, and no
+		new transaction can begin meanwhile, so autogrow requires transactions to
+		be short. If they don't end within timeout seconds, the grow fails with
+		MDB_MAP_FULL."""
+		if factor is not None and factor <= 1:
+			raise ValueError("Expected factor to be greater than 1, got {}".format(factor))
+		self.grow_factor = factor
+		self.grow_limit = limit
+		self.grow_retries = retries
+		self.grow_timeout = timeout
+
+	def grow(self):
+		"""Grow the map according to the autogrow policy and return the new size.
+		This waits up to grow_timeout seconds until the transactions of other
+		threads have ended, and fails with MDB_MAP_FULL if they don't or if the
+		current thread has an open transaction."""
+		if self._resize_lock.held():
+			raise APIError(MDB_MAP_FULL,
+				"Can't grow the map while this thread has an open transaction")
+		try:
+			with self._resize_lock.exclusive(self.grow_timeout):
+				size = self.mapsize
+				new_size = int(size * self.grow_factor)
+				if self.grow_limit is not None:
+					new_size = min(new_size, self.grow_limit)
+				if new_size <= size:
+					raise APIError(MDB_MAP_FULL,
+						"Map size limit of {} bytes reached".format(size))
+				self.set_mapsize(new_size)
+		except TimeoutError as e:
+			raise APIError(MDB_MAP_FULL, "Can't grow the map: {}".format(e))
+		return new_size
+
+	def _adopt_mapsize(self):
+		"""Adopt the map size set by another process, once the transactions of
+		other threads have ended. Return False if the current thread has an open
+		transaction or the others don't end within grow_timeout seconds, so the
+		map can't be remapped."""
+		if self._resize_lock.held():
+			return False
+		try:
+			with self._resize_lock.exclusive(self.grow_timeout):
+				self.set_mapsize(0)
+		except TimeoutError:
+			return False
+		return True
+
+	def instrument(self, metrics=None):
+		"""Record count, bytes and latency of the operations of transactions begun
+		from now on, and the sizes of their commits, in metrics or a new
+		lmdb.metrics.Metrics instance, and return it."""
+		self.uninstrument()
+		self._lib = self._lib.instrument(metrics)
+		return self._lib.metrics
+
+	def uninstrument(self):
+		"""Stop recording metrics for transactions begun from now on."""
+		from lmdb.metrics import InstrumentedLibLMDB
+		if isinstance(self._lib, InstrumentedLibLMDB):
+			self._lib = self._lib.lib
+
+	@property
+	def metrics(self):
+		"""Metrics instance passed to instrument, or None."""
+		return getattr(self._lib, "metrics", None)
 	
 	def set_maxreaders(self, maxreaders):
 		"""Set maximum readers count for this environment."""
@@ -716,6 +1235,13 @@ class Environment(object):
 		"""Get maximum readers count for this environment."""
 		return self._lib.env_get_maxreaders(self._handle)
 
+	@property
+	def readers(self):
+		"""Return list of (pid, thread, txnid) tuples for the reader slots in use,
+		see LibLMDB.reader_list. Unlike EnvInfo.me_numreaders, which is the
+		highest slot ever used, this only counts slots which are taken now."""
+		return self._lib.reader_list(self._handle)
+
 	def set_maxdbs(self, maxdbs):
 		"""Set maximum database count for this environment."""
 		self._lib.env_set_maxdbs(self._handle, maxdbs)
@@ -724,24 +1250,193 @@ class Environment(object):
 		"""Get maximum key size for this environment."""
 		return self._lib.env_get_maxkeysize(self._handle)
 
-	def transaction(self, flags=0, write=True, db=None):
+	def open_database(self, txn, name=None, flags=0, key_codec=None,
+			value_codec=None):
+		"""Return tuple of database handle, key codec and value codec for name. The
+		database is opened in the supplied transaction when it isn't known to this
+		environment yet. Handles become shared by all transactions once the
+		opening transaction commits. Explicit codecs only apply to the returned
+		tuple. Otherwise codecs default to the ones registered by set_codecs,
+		IntegerCodec for MDB_INTEGERKEY and MDB_INTEGERDUP databases, the codecs of
+		this environment and finally ObjectCodec."""
+		if isinstance(name, str):
+			name = name.encode()
+		registry = self._databases
+		entry = registry.get(name)
+		parent = txn
+		while entry is None and parent is not None:
+			registry = parent._databases
+			entry = registry.get(name)
+			parent = parent._parent
+		if entry is None:
+			registry = txn._databases
+			dbi = self._lib.dbi_open(txn._handle, name, flags)
+			db_flags = self._lib.dbi_flags(txn._handle, dbi).value
+			preset_key_codec, preset_value_codec = self._codecs.get(name, (None, None))
+			entry = (dbi,
+				preset_key_codec
+					or (IntegerCodec() if db_flags & MDB_INTEGERKEY else None)
+					or self.key_codec or ObjectCodec(),
+				preset_value_codec
+					or (IntegerCodec() if db_flags & MDB_INTEGERDUP else None)
+					or self.value_codec or ObjectCodec())
+			registry[name] = entry
+		if key_codec is not None or value_codec is not None:
+			entry = (entry[0], key_codec or entry[1], value_codec or entry[2])
+		return entry
+
+	def set_codecs(self, name=None, key_codec=None, value_codec=None):
+		"""Register codecs for the database name, which are used by all following
+		transactions. Passing None keeps the current codec."""
+		if isinstance(name, str):
+			name = name.encode()
+		preset = self._codecs.get(name, (None, None))
+		self._codecs[name] = (key_codec or preset[0], value_codec or preset[1])
+		entry = self._databases.get(name)
+		if entry is not None:
+			self._databases[name] = (entry[0], key_codec or entry[1],
+				value_codec or entry[2])
+
+	def close_database(self, name=None):
+		"""Close shared database handle for name. This must not be done while any
+		transaction still uses the handle."""
+		if isinstance(name, str):
+			name = name.encode()
+		entry = self._databases.pop(name, None)
+		if entry is not None:
+			self._lib.dbi_close(self._handle, entry[0])
+
+	def _spare_txn_pool(self):
+		"""Return pool of reset read-only transaction handles of the current thread."""
+		try:
+			return self._spare_txns.pool
+		except AttributeError:
+			pool = self._spare_txns.pool = []
+			with self._spare_txn_lock:
+				self._spare_txn_pools[id(pool)] = pool
+			# The thread-local attributes are dropped when the thread exits, which
+			# aborts the pooled handles of the thread.
+			token = self._spare_txns.token = _ThreadToken()
+			weakref.finalize(token, Environment._drop_spare_txn_pool,
+				weakref.ref(self), pool)
+			return pool
+
+	@staticmethod
+	def _drop_spare_txn_pool(env_ref, pool):
+		env = env_ref()
+		if env is None:
+			return
+		with env._spare_txn_lock:
+			env._spare_txn_pools.pop(id(pool), None)
+			while pool:
+				env._lib.txn_abort(pool.pop())
+
+	def _take_spare_txn(self):
+		"""Return renewed read-only transaction handle from the pool of the current
+		thread, or None if the pool is empty."""
+		pool = self._spare_txn_pool()
+		while pool:
+			handle = pool.pop()
+			try:
+				self._lib.txn_renew(handle)
+			except APIError:
+				self._lib.txn_abort(handle)
+			else:
+				return handle
+
+	def _give_spare_txn(self, handle):
+		"""Reset read-only transaction handle and keep it for reuse by the current
+		thread. Return False if the pool is full and the handle wasn't taken."""
+		pool = self._spare_txn_pool()
+		if self._handle is None or len(pool) >= self.max_spare_txns:
+			return False
+		self._lib.txn_reset(handle)
+		pool.append(handle)
+		return True
+
+	def _abort_spare_txns(self):
+		with self._spare_txn_lock:
+			for pool in self._spare_txn_pools.values():
+				while pool:
+					self._lib.txn_abort(pool.pop())
+
+	def transaction(self, flags=0, write=True, db=None, buffers=None):
 		if write is False:
 			flags |= MDB_RDONLY
-		return Transaction(self, flags=flags, db=db)
+		return Transaction(self, flags=flags, db=db, buffers=buffers)
 
 	begin = transaction
 
+	def bulk_load(self, iterable, db=None, presorted=False, chunk_size=100000,
+			run_size=1000000):
+		"""Load (key, value) pairs from an iterable or dict into a database with
+		MDB_APPEND and return the number of items. Unless presorted is True, the
+		input is sorted first, using temporary files for more than run_size items.
+		A transaction is committed after every chunk_size items. All keys must be
+		unique and greater than the keys already stored in the database."""
+		if isinstance(iterable, dict):
+			iterable = iterable.items()
+		def codecs(txn):
+			database = txn.database(db, MDB_CREATE)
+			return database.key_codec, database.value_codec
+		key_codec, value_codec = self.run(codecs)
+		items = ((object_to_bytes(k), object_to_bytes(v))
+			for k, v in encode_items(iterable, key_codec, value_codec))
+		if not presorted:
+			items = sort_items(items, run_size, key_codec.sort_key)
+		def load(txn):
+			# Items are encoded already, so the cursor is driven directly.
+			with closing(txn.database(db, MDB_CREATE).cursor()) as cursor:
+				return self._lib.cursor_put_many(cursor._handle, chunk, MDB_APPEND)
+		count = 0
+		while True:
+			# The chunk is materialized, so it can be replayed after growing the map.
+			chunk = list(itertools.islice(items, chunk_size))
+			loaded = self.run(load)
+			count += loaded
+			if loaded < chunk_size:
+				return count
+
+	def run(self, func, write=True, db=None):
+		"""Call func with a new transaction, commit it and return the result of func.
+		If the transaction fails with MDB_MAP_FULL and autogrow is enabled, the map
+		is grown and func is called again with a fresh transaction."""
+		retries = self.grow_retries if self.grow_factor is not None else 0
+		while True:
+			txn = self.transaction(write=write, db=db)
+			try:
+				res = func(txn)
+				txn.commit()
+				return res
+			except APIError as e:
+				txn.abort()
+				if e.code != MDB_MAP_FULL or retries <= 0:
+					raise
+				retries -= 1
+				self.grow()
+			except:
+				txn.abort()
+				raise
+
+	def writer(self, max_delay=0.0, max_batch=1000, max_pending=0):
+		"""Return new Writer, which coalesces writes submitted by any thread into
+		shared write transactions. Writes share commits only within one Writer, so
+		it should be shared by all threads."""
+		return Writer(self, max_delay, max_batch, max_pending)
+
 	def __getitem__(self, key):
 		with self.transaction(write=False) as txn:
 			return txn[key]
 
 	def __setitem__(self, key, value):
-		with self.transaction(write=True) as txn:
+		def put(txn):
 			txn[key] = value
+		self.run(put)
 
 	def __delitem__(self, key):
-		with self.transaction(write=True) as txn:
+		def delete(txn):
 			del txn[key]
+		self.run(delete)
 	
 	def __contains__(self, key):
 		try:
@@ -800,12 +1495,20 @@ class Transaction(object):
 
 	_primary_database = None
 	_handle = None
+	_spare = False
+	_resize_holder = None
 
-	def __init__(self, env, db=None, parent=None, flags=0, lib=None):
+	def __init__(self, env, db=None, parent=None, flags=0, lib=None, buffers=None):
 		if lib is None:
 			lib = env._lib
+		if buffers is None:
+			buffers = env.buffers
 		self._lib = lib
 		self._primary_db = db
+		self._parent = parent
+		self._databases = {}
+		self._buffers = []
+		self.buffers = buffers
 		self.env = env
 		self.begin(parent, flags)
 
@@ -826,54 +1529,133 @@ class Transaction(object):
 			self.abort()
 	
 	def begin(self, parent=None, flags=0):
-		"""Begin new transaction by allocating a transaction handle."""
+		"""Begin new transaction by allocating a transaction handle. Top-level
+		read-only transactions reuse handles from the environment's pool. The
+		transaction holds the environment's resize lock shared until it ends."""
 		if self._handle is None:
-			self._handle = self._lib.txn_begin(self.env._handle,
-				parent._handle if parent is not None else None,
+			lock = self.env._resize_lock
+			self._resize_holder = lock.acquire_shared()
+			try:
+				self._begin(parent, flags)
+			except:
+				self._release_resize_lock()
+				raise
+
+	def _begin(self, parent, flags):
+		self._spare = parent is None and flags == MDB_RDONLY
+		if self._spare:
+			self._handle = self.env._take_spare_txn()
+			if self._handle is not None:
+				return
+		parent_handle = parent._handle if parent is not None else None
+		try:
+			self._handle = self._lib.txn_begin(self.env._handle, parent_handle,
 				flags)
+		except APIError as e:
+			if e.code != MDB_MAP_RESIZED:
+				raise
+			# Another process grew the map, so adopt its new size and retry. The
+			# map may only be remapped while no transaction uses it.
+			self._release_resize_lock()
+			if not self.env._adopt_mapsize():
+				raise
+			self._resize_holder = self.env._resize_lock.acquire_shared()
+			self._handle = self._lib.txn_begin(self.env._handle, parent_handle,
+				flags)
+
+	def _release_resize_lock(self):
+		if self._resize_holder is not None:
+			self.env._resize_lock.release_shared(self._resize_holder)
+			self._resize_holder = None
 
 	def transaction(self, flags=0):
 		"""Return new sub-transaction from this transaction."""
-		return Transaction(self.env, self, flags)
+		return Transaction(self.env, parent=self, flags=flags)
 
 	def commit(self):
 		"""Commit this transaction. After committing it you have to rebegin it."""
 		try:
+			self._release_buffers()
 			self._close_databases()
-			self._lib.txn_commit(self._handle)
+			# Committing a read-only transaction equals aborting it, unless it
+			# opened new databases which have to be kept.
+			if not (self._spare and not self._databases and self._give_back()):
+				self._lib.txn_commit(self._handle)
 		except InvalidHandleError:
 			pass
+		else:
+			# Database handles opened by this transaction survive the commit and
+			# are handed to the parent transaction or the environment.
+			if self._parent is not None:
+				self._parent._databases.update(self._databases)
+			else:
+				self.env._databases.update(self._databases)
 		finally:
+			self._databases.clear()
 			self._handle = None
+			self._release_resize_lock()
 	
 	def abort(self):
 		"""Abort this transaction. After aborting it you have to rebegin it."""
 		try:
+			self._release_buffers()
 			self._close_databases()
-			self._lib.txn_abort(self._handle)
+			if not (self._spare and self._give_back()):
+				self._lib.txn_abort(self._handle)
 		except InvalidHandleError:
 			pass
 		finally:
+			self._databases.clear()
 			self._handle = None
+			self._release_resize_lock()
 
 	def reset(self):
 		"""Reset this transaction."""
+		self._release_buffers()
 		self._close_databases()
+		self._databases.clear()
 		self._lib.txn_reset(self._handle)
+		# A reset transaction doesn't use the map until it is renewed.
+		self._release_resize_lock()
 
 	def renew(self):
 		"""Renew this transaction after resetting it."""
-		self._lib.txn_renew(self._handle)
+		if self._resize_holder is None:
+			self._resize_holder = self.env._resize_lock.acquire_shared()
+		try:
+			self._lib.txn_renew(self._handle)
+		except:
+			self._release_resize_lock()
+			raise
 
-	def database(self, name=None, flags=0):
+	def database(self, name=None, flags=0, key_codec=None, value_codec=None):
 		"""Return database object for the associated environment."""
-		return Database(self, name, flags)
+		return Database(self, name, flags, key_codec=key_codec,
+			value_codec=value_codec)
 
 	def cursor(self):
 		return Cursor(self)
 
 	def update(self, iterable):
 		self.primary_database.update(iterable)
+
+	def reserve(self, key, size, flags=0):
+		return self.primary_database.reserve(key, size, flags)
+
+	def get_many(self, keys, default=None, buffers=None):
+		return self.primary_database.get_many(keys, default, buffers)
+
+	def put_many(self, items, flags=0):
+		return self.primary_database.put_many(items, flags)
+
+	def delete_many(self, keys):
+		return self.primary_database.delete_many(keys)
+
+	def get_array(self, keys, out=None, fill=None):
+		return self.primary_database.get_array(keys, out, fill)
+
+	def put_array(self, keys, array, flags=0):
+		return self.primary_database.put_array(keys, array, flags)
 	
 	def keys(self):
 		return self.primary_database.keys()
@@ -905,6 +1687,36 @@ class Transaction(object):
 	def __repr__(self):
 		return "<Transaction [{0}] {1:x}>".format("active" if self._handle is not None else "inactive", id(self))
 
+	def _give_back(self):
+		"""Return handle of this transaction into the environment's pool."""
+		if self._handle is None:
+			raise InvalidHandleError("txn_reset")
+		return self.env._give_spare_txn(self._handle)
+
+	def _track_buffer(self, buf):
+		"""Remember buffer view which aliases memory owned by this transaction, so it
+		can be released when the transaction ends."""
+		self._buffers.append(buf)
+		return buf
+
+	def _release_buffers(self):
+		for buf in self._buffers:
+			try:
+				buf.release()
+			except BufferError:
+				# The view is exported to another object, e.g. a NumPy array, so we
+				# can't invalidate it from here. Slices and other views derived from
+				# it aren't invalidated by release() either.
+				pass
+		del self._buffers[:]
+
+	def _value_to_object(self, value, buffers=None):
+		if buffers is None:
+			buffers = self.buffers
+		if buffers:
+			return self._track_buffer(value.to_buffer())
+		return value.to_bytes()
+
 	def _close_databases(self):
 		if self._primary_database is not None:
 			self.primary_database.close()
@@ -923,12 +1735,16 @@ class Database(object):
 
 	_handle = None
 
-	def __init__(self, transaction, name, flags=0, lib=None):
+	def __init__(self, transaction, name, flags=0, lib=None, key_codec=None,
+			value_codec=None):
 		if lib is None:
 			lib = transaction._lib
 		self._lib = lib
 		self.transaction = transaction
-		self._handle = self._lib.dbi_open(transaction._handle, name, flags)
+		self.name = name
+		self._handle, self.key_codec, self.value_codec = \
+			transaction.env.open_database(transaction, name, flags, key_codec,
+				value_codec)
 
 	def __enter__(self):
 		return self
@@ -952,13 +1768,9 @@ class Database(object):
 		return self._lib.dbi_flags(self.transaction._handle, self._handle)
 
 	def close(self):
-		"""Close this database handle."""
-		try:
-			self._lib.dbi_close(self.transaction._handle, self._handle)
-		except InvalidHandleError:
-			pass
-		finally:
-			self._handle = None
+		"""Release this database object. The underlying handle stays open in the
+		environment, see Environment.close_database."""
+		self._handle = None
 
 	def empty(self):
 		"""Empty this database."""
@@ -967,44 +1779,219 @@ class Database(object):
 	def drop(self):
 		"""Drop this database and close it."""
 		self._lib.drop(self.transaction._handle, self._handle, True)
-
-	def get(self, key):
-		"""Get item from database."""
-		if not isinstance(key, Value):
-			key = Value.from_object(key)
-		res = self._lib.get(self.transaction._handle, self._handle, key)
-		return res.to_bytes()
+		name = self.name.encode() if isinstance(self.name, str) else self.name
+		self.transaction._databases.pop(name, None)
+		self.transaction.env._databases.pop(name, None)
+		self._handle = None
+
+	def _encode_key(self, key):
+		if isinstance(key, Value):
+			return key
+		return Value.from_bytes(self.key_codec.encode(key))
+
+	def _encode_value(self, value):
+		if isinstance(value, Value):
+			return value
+		return Value.from_bytes(self.value_codec.encode(value))
+
+	def _pack_key(self, key):
+		"""Encode key like _encode_key, but leave bytes as they are, which LibLMDB
+		passes without creating a Value."""
+		if isinstance(key, Value):
+			return key
+		key = self.key_codec.encode(key)
+		return key if type(key) is bytes else Value.from_bytes(key)
+
+	def _pack_value(self, value):
+		if isinstance(value, Value):
+			return value
+		value = self.value_codec.encode(value)
+		return value if type(value) is bytes else Value.from_bytes(value)
+
+	def _decode_key(self, key, buffers=None):
+		return self.key_codec.decode(self.transaction._value_to_object(key, buffers))
+
+	def _decode_value(self, value, buffers=None):
+		return self.value_codec.decode(
+			self.transaction._value_to_object(value, buffers))
+
+	def get(self, key, buffers=None):
+		"""Get item from database. If buffers is True, return a read-only memoryview
+		into the memory map instead of a bytes copy, which is valid until the
+		transaction ends."""
+		res = self._lib.get(self.transaction._handle, self._handle,
+			self._pack_key(key))
+		return self._decode_value(res, buffers)
 
 	def put(self, key, value, flags=0):
 		"""Put item into database."""
-		if not isinstance(key, Value):
-			key = Value.from_object(key)
-		if not isinstance(value, Value):
-			value = Value.from_object(value)
-		self._lib.put(self.transaction._handle, self._handle, key, value, flags)
+		self._lib.put(self.transaction._handle, self._handle,
+			self._pack_key(key), self._pack_value(value), flags)
+
+	def reserve(self, key, size, flags=0):
+		"""Reserve space for a value of the supplied size and return a writable
+		memoryview into the memory map, which has to be filled before the
+		transaction ends. This can't be used with MDB_DUPSORT databases."""
+		value = Value()
+		value.mv_size = size
+		self._lib.put(self.transaction._handle, self._handle, self._pack_key(key),
+			value, flags | MDB_RESERVE)
+		return self.transaction._track_buffer(value.to_buffer(readonly=False))
 
 	def delete(self, key, value=None):
 		"""Delete item from database."""
-		if not isinstance(key, Value):
-			key = Value.from_object(key)
-		if value is not None and not isinstance(value, Value):
-			value = Value.from_object(value)
-		self._lib.delete(self.transaction._handle, self._handle, key, value)
+		if value is not None:
+			value = self._encode_value(value)
+		self._lib.delete(self.transaction._handle, self._handle,
+			self._pack_key(key), value)
 	
+	def get_many(self, keys, default=None, buffers=None):
+		"""Get items for many keys at once and return them as list in the same
+		order. Missing keys yield default."""
+		if buffers is None:
+			buffers = self.transaction.buffers
+		res = self._lib.get_many(self.transaction._handle, self._handle,
+			self.key_codec.encode_many(list(keys)), None, buffers)
+		if buffers:
+			for buf in res:
+				if buf is not None:
+					self.transaction._track_buffer(buf)
+		found = iter(self.value_codec.decode_many([buf for buf in res
+			if buf is not None]))
+		return [default if buf is None else next(found) for buf in res]
+
+	def put_many(self, items, flags=0):
+		"""Put many (key, value) pairs from an iterable or dict into database and
+		return the number of items."""
+		if isinstance(items, dict):
+			items = items.items()
+		return self._lib.put_many(self.transaction._handle, self._handle,
+			encode_items(items, self.key_codec, self.value_codec), flags)
+
+	def delete_many(self, keys):
+		"""Delete many keys from database and return the number of deleted items.
+		Missing keys are skipped."""
+		return self._lib.delete_many(self.transaction._handle, self._handle,
+			self.key_codec.encode_many(list(keys)))
+
 	def update(self, iterable):
-		if isinstance(iterable, dict):
-			iterable = iterable.items()
-		for key, value in iterable:
-			self[key] = value
+		self.put_many(iterable)
+
+	def get_array(self, keys, out=None, fill=None):
+		"""Read the values for a sequence of keys into the rows of a NumPy array and
+		return it. Without out, the array is allocated from the dtype and shape of
+		the NumpyCodec of this database, or from the size of the first value if the
+		codec has no shape. Rows of missing keys are set to fill, or KeyError is
+		raised if fill is None."""
+		objs = list(keys)
+		keys = self.key_codec.encode_many(objs)
+		if out is None:
+			out = self._alloc_array(keys)
+		elif len(out) != len(keys):
+			raise ValueError("Expected array of {} rows, got {}".format(len(keys),
+				len(out)))
+		if not out.flags.c_contiguous or not out.flags.writeable:
+			raise ValueError("Array must be writable and C-contiguous")
+		if not len(keys):
+			return out
+		missing = self._lib.get_rows(self.transaction._handle, self._handle, keys,
+			out.ctypes.data, out.nbytes // len(keys))
+		if missing:
+			if fill is None:
+				raise KeyError(objs[missing[0]])
+			out[missing] = fill
+		return out
+
+	def _alloc_array(self, keys):
+		codec = self.value_codec
+		if not isinstance(codec, NumpyCodec):
+			raise TypeError("get_array requires out or a NumpyCodec")
+		shape = codec.shape
+		if shape is None:
+			shape = (0,)
+			for buf in self._lib.get_many(self.transaction._handle, self._handle,
+					keys, None, True):
+				if buf is not None:
+					shape = (len(buf) // codec.dtype.itemsize,)
+					buf.release()
+					break
+		return codec._numpy.empty((len(keys),) + tuple(shape), codec.dtype)
+
+	def put_array(self, keys, array, flags=0):
+		"""Put the rows of a NumPy array as values for a sequence of keys and return
+		the number of items. The rows are written straight from the array, which is
+		converted to the dtype of the NumpyCodec of this database, if any."""
+		keys = self.key_codec.encode_many(list(keys))
+		codec = self.value_codec
+		if isinstance(codec, NumpyCodec):
+			array = codec._numpy.ascontiguousarray(array, dtype=codec.dtype)
+			if codec.shape is not None and array.shape[1:] != tuple(codec.shape):
+				raise ValueError("Expected rows of shape {}, got {}".format(codec.shape,
+					array.shape[1:]))
+		elif not array.flags.c_contiguous:
+			raise ValueError("Array must be C-contiguous")
+		if len(array) != len(keys):
+			raise ValueError("Expected array of {} rows, got {}".format(len(keys),
+				len(array)))
+		if not len(keys):
+			return 0
+		return self._lib.put_rows(self.transaction._handle, self._handle, keys,
+			array.ctypes.data, array.nbytes // len(keys), flags)
+
+	def add(self, key, value):
+		"""Add value to the values of key in a MDB_DUPSORT database. Return False if
+		the pair already exists."""
+		try:
+			self.put(key, value, MDB_NODUPDATA)
+		except APIError as e:
+			if e.code == MDB_KEYEXIST:
+				return False
+			raise
+		return True
+
+	def add_multiple(self, key, values, size=None):
+		"""Add many fixed-size values to key in a MDB_DUPFIXED database with a
+		single MDB_MULTIPLE put, see Cursor.put_multiple."""
+		with closing(self.cursor()) as cursor:
+			return cursor.put_multiple(key, values, size)
+
+	def iter_dups(self, key, buffers=None):
+		"""Iterate over all values of key in a MDB_DUPSORT database."""
+		with closing(self.cursor()) as cursor:
+			yield from cursor.iter_dups(key, buffers)
+
+	def iter_range(self, start=None, stop=None, reverse=False, keys=True,
+			values=True, buffers=None):
+		"""Iterate over items with start <= key < stop, see Cursor.iter_range."""
+		with closing(self.cursor()) as cursor:
+			yield from cursor.iter_range(start, stop, reverse, keys, values, buffers)
+
+	def iter_prefix(self, prefix, reverse=False, keys=True, values=True,
+			buffers=None):
+		"""Iterate over items whose keys start with prefix, see Cursor.iter_prefix."""
+		with closing(self.cursor()) as cursor:
+			yield from cursor.iter_prefix(prefix, reverse, keys, values, buffers)
+
+	def get_all(self, key, buffers=None):
+		"""Return list of all values of key in a MDB_DUPSORT database. MDB_DUPFIXED
+		databases are read a page at a time."""
+		with closing(self.cursor()) as cursor:
+			if not self.flags().value & MDB_DUPFIXED:
+				return list(cursor.iter_dups(key, buffers))
+			values = []
+			for page, size in cursor.iter_dup_pages(key, buffers):
+				values.extend(self.value_codec.decode_many([page[i:i + size]
+					for i in range(0, len(page), size)]))
+			return values
 
 	def items(self):
 		return self.cursor()
 
 	def values(self):
-		return map(lambda x: x[1], self.items())
+		return self.cursor().values()
 	
 	def keys(self):
-		return map(lambda x: x[0], self.items())
+		return self.cursor().keys()
 
 	def __len__(self):
 		return self.stat.ms_entries
@@ -1083,23 +2070,185 @@ class Cursor(object):
 	def renew(self, txn):
 		self._lib.cursor_renew(txn._handle, self._handle)
 
-	def get(self, op, key=None, data=None):
-		if not isinstance(key, Value):
-			key = Value.from_object(key)
-		if not isinstance(data, Value):
-			data = Value.from_object(data)
+	def get(self, op, key=None, data=None, buffers=None):
+		key = Value() if key is None else self.db._encode_key(key)
+		data = Value() if data is None else self.db._encode_value(data)
 		key, value = self._lib.cursor_get(self._handle, key, data, op)
-		return key.to_bytes(), data.to_bytes()
+		return self.db._decode_key(key, buffers), self.db._decode_value(data, buffers)
 
 	def put(self, key, data, flags=0):
-		if not isinstance(key, Value):
-			key = Value.from_object(key)
-		if not isinstance(data, Value):
-			data = Value.from_object(data)
-		self._lib.cursor_put(self._handle, key, data, flags)
+		self._lib.cursor_put(self._handle, self.db._encode_key(key),
+			self.db._encode_value(data), flags)
+
+	def put_many(self, items, flags=0):
+		"""Put many (key, value) pairs by this cursor and return the number of
+		items."""
+		return self._lib.cursor_put_many(self._handle,
+			encode_items(items, self.db.key_codec, self.db.value_codec), flags)
 
 	def delete(self, flags=0):
 		self._lib.cursor_del(self._handle, flags)
+
+	def iter_range(self, start=None, stop=None, reverse=False, keys=True,
+			values=True, buffers=None):
+		"""Iterate over items with start <= key < stop, using MDB_SET_RANGE to find
+		the first item. Yield (key, value) pairs, or only keys or values if the
+		other one is disabled."""
+		encode = self.db.key_codec.encode
+		if start is not None:
+			start = object_to_bytes(encode(start))
+		if stop is not None:
+			stop = object_to_bytes(encode(stop))
+		return self._iter_range(start, stop, reverse, keys, values, buffers)
+
+	def _iter_range(self, start, stop, reverse, keys, values, buffers):
+		"""Implementation of iter_range for encoded bounds."""
+		order = self.db.key_codec.sort_key
+		# LMDB doesn't accept empty keys, but all keys are >= b"" anyway.
+		start = start or None
+		if stop is not None and not stop:
+			return iter(())
+		if not reverse:
+			if start is None:
+				op, key = MDB_FIRST, Value()
+			else:
+				op, key = MDB_SET_RANGE, Value.from_bytes(start)
+			if stop is None:
+				until = None
+			else:
+				stop_order = order(stop)
+				until = lambda k: order(k) >= stop_order
+			return self._iterate(op, MDB_NEXT, key, keys, values, buffers, until)
+		op, key = MDB_LAST, Value()
+		if stop is not None:
+			key = Value.from_bytes(stop)
+			if self._position(MDB_SET_RANGE, key):
+				op = MDB_PREV
+		if start is None:
+			until = None
+		else:
+			start_order = order(start)
+			until = lambda k: order(k) < start_order
+		return self._iterate(op, MDB_PREV, key, keys, values, buffers, until)
+
+	def fetch_many(self, count, reverse=False, keys=True, values=True,
+			buffers=None):
+		"""Return list of up to count items following the current position of
+		this cursor, see iter_range for the item format. An empty list means that
+		the cursor reached the end."""
+		txn = self.db.transaction
+		if buffers is None:
+			buffers = txn.buffers
+		res = self._lib.cursor_get_many(self._handle,
+			MDB_PREV if reverse else MDB_NEXT, count, keys, values, buffers)
+		if buffers:
+			for item in res:
+				for buf in item if keys and values else (item,):
+					txn._track_buffer(buf)
+		if keys and values:
+			if not res:
+				return res
+			res_keys, res_values = zip(*res)
+			return list(zip(self.db.key_codec.decode_many(res_keys),
+				self.db.value_codec.decode_many(res_values)))
+		elif keys:
+			return self.db.key_codec.decode_many(res)
+		return self.db.value_codec.decode_many(res)
+
+	def iter_chunks(self, count=1000, reverse=False, keys=True, values=True,
+			buffers=None):
+		"""Iterate over the remaining items in lists of up to count items."""
+		while True:
+			chunk = self.fetch_many(count, reverse, keys, values, buffers)
+			if not chunk:
+				return
+			yield chunk
+
+	def iter_dups(self, key, buffers=None):
+		"""Iterate over all values of key in a MDB_DUPSORT database."""
+		return self._iterate(MDB_SET_KEY, MDB_NEXT_DUP, self.db._encode_key(key),
+			False, True, buffers)
+
+	def iter_dup_pages(self, key, buffers=None):
+		"""Iterate over the values of key in a MDB_DUPFIXED database a page at a
+		time, using MDB_GET_MULTIPLE and MDB_NEXT_MULTIPLE. Yield pairs of the
+		packed values and the size of a single value."""
+		key, data = self.db._encode_key(key), Value()
+		if not self._position(MDB_SET_KEY, key, data):
+			return
+		size = data.mv_size
+		to_object = self.db.transaction._value_to_object
+		op = MDB_GET_MULTIPLE
+		while self._position(op, key, data):
+			yield to_object(data, buffers), size
+			op = MDB_NEXT_MULTIPLE
+
+	def put_multiple(self, key, values, size=None):
+		"""Store many values of the same size for key in a MDB_DUPFIXED database
+		with MDB_MULTIPLE. values is either a list of bytes objects or a packed
+		bytes-like object of values with the supplied size. Return the number of
+		stored values."""
+		if size is None:
+			values = [object_to_bytes(value)
+				for value in self.db.value_codec.encode_many(list(values))]
+			if not values:
+				return 0
+			size = len(values[0])
+			values = b"".join(values)
+		packed = Value.from_bytes(values)
+		if not size or packed.mv_size % size:
+			raise ValueError("Expected values to be a multiple of {} bytes".format(size))
+		data = (Value * 2)()
+		data[0].mv_size, data[0].mv_data = size, packed.mv_data
+		data[1].mv_size = packed.mv_size // size
+		self._lib.cursor_put(self._handle, self.db._encode_key(key), data,
+			MDB_MULTIPLE)
+		return data[1].mv_size
+
+	def keys(self, buffers=None):
+		"""Iterate over all keys without copying any values."""
+		return self.iter_range(values=False, buffers=buffers)
+
+	def values(self, buffers=None):
+		"""Iterate over all values without copying any keys."""
+		return self.iter_range(keys=False, buffers=buffers)
+
+	def iter_prefix(self, prefix, reverse=False, keys=True, values=True,
+			buffers=None):
+		"""Iterate over items whose keys start with prefix, see iter_range. With
+		TupleCodec keys, a tuple prefix selects all keys with these leading
+		elements."""
+		prefix = object_to_bytes(self.db.key_codec.encode(prefix))
+		return self._iter_range(prefix, prefix_successor(prefix), reverse, keys,
+			values, buffers)
+
+	def _position(self, op, key, data=None):
+		"""Move cursor by op and return False if no item was found."""
+		try:
+			self._lib.cursor_get(self._handle, key,
+				Value() if data is None else data, op)
+		except APIError as e:
+			if e.code == MDB_NOTFOUND:
+				return False
+			raise
+		return True
+
+	def _iterate(self, op, next_op, key, keys, values, buffers, until=None):
+		"""Yield items starting with op and continuing with next_op. Iteration stops
+		before the first key for which until returns True, so nothing past the
+		boundary is copied."""
+		decode_key, decode_value = self.db._decode_key, self.db._decode_value
+		data = Value()
+		while self._position(op, key, data):
+			if until is not None and until(key.to_bytes()):
+				return
+			op = next_op
+			if keys and values:
+				yield decode_key(key, buffers), decode_value(data, buffers)
+			elif keys:
+				yield decode_key(key, buffers)
+			else:
+				yield decode_value(data, buffers)
 	
 	def next(self):
 		return self.get(MDB_NEXT)
@@ -1133,8 +2282,197 @@ class Cursor(object):
 	def __repr__(self):
 		return "<Cursor [{0}] {1:x}>".format("active" if self._handle is not None else "inactive", id(self))
 
+class _WriteFailed(Exception):
+	"""Raised by a Writer batch to abort the shared transaction after the write
+	at index failed with error."""
+
+	def __init__(self, index, error):
+		Exception.__init__(self, index, error)
+		self.index = index
+		self.error = error
+
+class Writer(object):
+	"""Queue of writes with a writer thread, which calls them in shared write
+	transactions. The thread takes the first pending write, collects further
+	writes for up to max_delay seconds or until max_batch writes are collected,
+	runs them with Environment.run and commits before resolving their futures.
+	submit blocks while max_pending writes are queued, unless it is 0.
+
+	Every write runs in a nested transaction, which is aborted if it raises, so
+	a failing write fails only its own future. MDB_WRITEMAP environments don't
+	support nested transactions, so the shared transaction is aborted instead and
+	the batch is run again without the failed write. Durable writes are resolved
+	after the environment has been synced to disk, which is only necessary if it
+	was opened with MDB_NOSYNC, MDB_NOMETASYNC or MDB_MAPASYNC."""
+
+	_ASYNC_FLAGS = MDB_NOSYNC | MDB_NOMETASYNC | MDB_MAPASYNC
+
+	def __init__(self, env, max_delay=0.0, max_batch=1000, max_pending=0):
+		self.env = env
+		self.max_delay = max_delay
+		self.max_batch = max_batch
+		self._queue = queue.Queue(max_pending)
+		self._thread = None
+		self._lock = threading.Lock()
+		self._closed = False
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def submit(self, func, durable=False):
+		"""Queue func to be called with a write transaction and return a Future of
+		its result, which is resolved after the transaction is committed, and
+		synced to disk if durable is True."""
+		future = concurrent.futures.Future()
+		# Holding the lock while queueing keeps close() from queueing its stop
+		# marker in between, which would leave this future unresolved.
+		with self._lock:
+			if self._closed:
+				raise RuntimeError("Writer is closed")
+			if self._thread is None:
+				self._start()
+			self._queue.put((func, durable, future))
+		return future
+
+	def put(self, key, value, db=None, flags=0, durable=False):
+		"""Queue storing value under key and return a Future of None."""
+		def put(txn):
+			txn.database(db).put(key, value, flags)
+		return self.submit(put, durable)
+
+	def delete(self, key, db=None, durable=False):
+		"""Queue deleting key and return a Future, which raises KeyError if the key
+		is missing."""
+		def delete(txn):
+			del txn.database(db)[key]
+		return self.submit(delete, durable)
+
+	def flush(self):
+		"""Wait until all writes submitted so far are committed."""
+		self.submit(lambda txn: None).result()
+
+	def close(self):
+		"""Commit the pending writes and stop the writer thread."""
+		with self._lock:
+			if self._closed:
+				return
+			self._closed = True
+			thread = self._thread
+			if thread is not None:
+				self._queue.put(None)
+		if thread is not None:
+			thread.join()
+
+	def _start(self):
+		# The thread is started lazily, so a process can fork before the first
+		# write. The caller holds the lock.
+		self._thread = threading.Thread(target=self._run, name="lmdb-writer",
+			daemon=True)
+		self._thread.start()
+
+	def _collect(self):
+		batch = [self._queue.get()]
+		deadline = time.monotonic() + self.max_delay
+		while batch[-1] is not None and len(batch) < self.max_batch:
+			timeout = deadline - time.monotonic()
+			try:
+				if timeout > 0:
+					batch.append(self._queue.get(timeout=timeout))
+				else:
+					batch.append(self._queue.get_nowait())
+			except queue.Empty:
+				break
+		return batch
+
+	def _run(self):
+		while True:
+			batch = self._collect()
+			stop = batch[-1] is None
+			if stop:
+				batch.pop()
+			batch = [write for write in batch
+				if write[2].set_running_or_notify_cancel()]
+			if batch:
+				self._commit(batch)
+			if stop:
+				return
+
+	def _commit(self, batch):
+		nested = not self.env.get_flags() & MDB_WRITEMAP
+		results = []
+		def run_batch(txn):
+			# Environment.run calls this again after growing the map.
+			del results[:]
+			for i, (func, _, _) in enumerate(batch):
+				child = txn.transaction() if nested else txn
+				try:
+					res = func(child)
+					if nested:
+						child.commit()
+				except Exception as e:
+					if nested:
+						child.abort()
+					if isinstance(e, APIError) and e.code == MDB_MAP_FULL:
+						raise
+					if not nested:
+						raise _WriteFailed(i, e)
+					results.append((False, e))
+				else:
+					results.append((True, res))
+		try:
+			while True:
+				try:
+					self.env.run(run_batch)
+					break
+				except _WriteFailed as failed:
+					self._resolve(batch[failed.index][2], (False, failed.error))
+					batch = batch[:failed.index] + batch[failed.index + 1:]
+					if not batch:
+						return
+			durable = [(write, res) for write, res in zip(batch, results)
+				if write[1]]
+			if durable and self.env.get_flags() & self._ASYNC_FLAGS:
+				for write, res in zip(batch, results):
+					if not write[1]:
+						self._resolve(write[2], res)
+				batch, results = zip(*durable)
+				self.env.sync(True)
+		except Exception as e:
+			for _, _, future in batch:
+				future.set_exception(e)
+			return
+		for write, res in zip(batch, results):
+			self._resolve(write[2], res)
+
+	@staticmethod
+	def _resolve(future, res):
+		ok, value = res
+		if ok:
+			future.set_result(value)
+		else:
+			future.set_exception(value)
+
+def load_lib(backend=None, path=None):
+	"""Return LibLMDB instance for backend "ctypes" or "cffi". The cffi backend
+	always uses the liblmdb which lmdb._lmdb_cffi was built against, and falls back
+	to ctypes if that extension is missing. Without backend, cffi is preferred
+	unless a library path is given."""
+	if backend == "cffi" or (backend is None and path is None):
+		try:
+			from lmdb.cffi_backend import CffiLibLMDB
+		except ImportError:
+			pass
+		else:
+			return CffiLibLMDB()
+	elif backend not in (None, "ctypes"):
+		raise ValueError("Unknown backend {}".format(backend))
+	return LibLMDB(path)
+
 try:
-  lib = LibLMDB(os.environ.get("LMDB_SO_PATH"))
+  lib = load_lib(os.environ.get("LMDB_BACKEND"), os.environ.get("LMDB_SO_PATH"))
 except lmdb.APIError:
   pass
 
@@ -0,0 +1,318 @@
+# coding: utf-8
+
+import ctypes
+import threading
+import time
+
+from lmdb.lmdb import MDB_RDONLY
+
+class Histogram(object):
+	"""Histogram of non-negative integers with buckets whose exclusive upper
+	bounds are the powers of two from 2**low to 2**high, and an overflow
+	bucket."""
+
+	def __init__(self, low, high):
+		self.low = low
+		self.high = high
+		self.counts = [0] * (high - low + 2)
+		self.count = 0
+		self.sum = 0
+
+	def add(self, value):
+		i = value.bit_length() - self.low
+		if i < 0:
+			i = 0
+		elif i > self.high - self.low:
+			i = self.high - self.low + 1
+		self.counts[i] += 1
+		self.count += 1
+		self.sum += value
+
+	def snapshot(self, scale=1):
+		"""Return dict with count, sum and a list of (upper bound, count) buckets.
+		Bounds and sum are multiplied by scale."""
+		bounds = [2 ** i * scale for i in range(self.low, self.high + 1)]
+		return {
+			"count": self.count,
+			"sum": self.sum * scale,
+			"buckets": list(zip(bounds + [float("inf")], self.counts))
+		}
+
+class Metrics(object):
+	"""Counters and histograms for the operations recorded by
+	InstrumentedLibLMDB. Latencies are recorded in nanoseconds from 1 us to 17 s,
+	and commit sizes as the number of written items and their bytes."""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self._lock:
+			self.ops = {}
+			self.commit_writes = Histogram(0, 24)
+			self.commit_bytes = Histogram(0, 40)
+
+	def record(self, op, elapsed, nbytes=0):
+		"""Record a call of op which took elapsed nanoseconds and transferred nbytes
+		of keys and values."""
+		with self._lock:
+			try:
+				latency, total = self.ops[op]
+			except KeyError:
+				latency, total = Histogram(10, 34), 0
+			latency.add(elapsed)
+			self.ops[op] = latency, total + nbytes
+
+	def record_commit(self, writes, nbytes):
+		with self._lock:
+			self.commit_writes.add(writes)
+			self.commit_bytes.add(nbytes)
+
+	def snapshot(self):
+		"""Return the current values as dict of plain objects. Latencies are given in
+		seconds."""
+		with self._lock:
+			ops = {}
+			for op, (latency, total) in self.ops.items():
+				hist = latency.snapshot(1e-9)
+				ops[op] = {
+					"count": hist["count"],
+					"bytes": total,
+					"seconds": hist["sum"],
+					"latency": hist["buckets"]
+				}
+			return {
+				"ops": ops,
+				"commits": {
+					"count": self.commit_writes.count,
+					"writes": self.commit_writes.snapshot(),
+					"bytes": self.commit_bytes.snapshot()
+				}
+			}
+
+def _size(obj):
+	"""Return size of a bytes-like object, Value or MDB_MULTIPLE value array."""
+	if isinstance(obj, ctypes.Array):
+		return obj[0].mv_size * obj[1].mv_size
+	try:
+		return obj.mv_size
+	except AttributeError:
+		return len(obj)
+
+def _key(handle):
+	"""Return hashable key for a ctypes or integer handle."""
+	return getattr(handle, "value", handle)
+
+class InstrumentedLibLMDB(object):
+	"""Proxy for a LibLMDB instance, which records the latency and transferred
+	bytes of transaction, get, put, delete and cursor operations in a Metrics
+	instance, and the number of writes and their bytes for every committed write
+	transaction. All other methods are passed through."""
+
+	def __init__(self, lib, metrics=None):
+		self.lib = lib
+		self.metrics = Metrics() if metrics is None else metrics
+		# Writes of active write transactions as [writes, bytes, parent] and the
+		# transactions of open cursors, by handle.
+		self._txns = {}
+		self._cursors = {}
+
+	def __getattr__(self, name):
+		return getattr(self.lib, name)
+
+	def _write(self, txn, writes, nbytes):
+		try:
+			entry = self._txns[_key(txn)]
+		except KeyError:
+			return
+		entry[0] += writes
+		entry[1] += nbytes
+
+	# Transaction operations are only recorded if they succeed, so the abort()
+	# which Transaction.__del__ calls after a commit isn't counted.
+
+	def txn_begin(self, env, parent, flags):
+		start = time.perf_counter_ns()
+		txn = self.lib.txn_begin(env, parent, flags)
+		self.metrics.record("txn_begin", time.perf_counter_ns() - start)
+		if not flags & MDB_RDONLY:
+			self._txns[_key(txn)] = [0, 0, parent]
+		return txn
+
+	def txn_renew(self, txn):
+		start = time.perf_counter_ns()
+		self.lib.txn_renew(txn)
+		self.metrics.record("txn_renew", time.perf_counter_ns() - start)
+
+	def txn_commit(self, txn):
+		if txn is None:
+			return self.lib.txn_commit(txn)
+		# The entry is removed first, as the handle may be reused by a transaction
+		# of another thread as soon as it is freed. A failed commit aborts the
+		# transaction anyway.
+		entry = self._txns.pop(_key(txn), None)
+		start = time.perf_counter_ns()
+		self.lib.txn_commit(txn)
+		self.metrics.record("txn_commit", time.perf_counter_ns() - start)
+		if entry is not None:
+			writes, nbytes, parent = entry
+			if parent is not None:
+				self._write(parent, writes, nbytes)
+			else:
+				self.metrics.record_commit(writes, nbytes)
+
+	def txn_abort(self, txn):
+		if txn is None:
+			return self.lib.txn_abort(txn)
+		self._txns.pop(_key(txn), None)
+		start = time.perf_counter_ns()
+		self.lib.txn_abort(txn)
+		self.metrics.record("txn_abort", time.perf_counter_ns() - start)
+
+	def get(self, txn, dbi, key):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			res = self.lib.get(txn, dbi, key)
+			nbytes = _size(key) + res.mv_size
+			return res
+		finally:
+			self.metrics.record("get", time.perf_counter_ns() - start, nbytes)
+
+	def put(self, txn, dbi, key, value, flags):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			self.lib.put(txn, dbi, key, value, flags)
+			nbytes = _size(key) + _size(value)
+			self._write(txn, 1, nbytes)
+		finally:
+			self.metrics.record("put", time.perf_counter_ns() - start, nbytes)
+
+	def delete(self, txn, dbi, key, value):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			self.lib.delete(txn, dbi, key, value)
+			nbytes = _size(key)
+			self._write(txn, 1, nbytes)
+		finally:
+			self.metrics.record("delete", time.perf_counter_ns() - start, nbytes)
+
+	def get_many(self, txn, dbi, keys, default=None, buffers=False):
+		keys = list(keys)
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			res = self.lib.get_many(txn, dbi, keys, default, buffers)
+			nbytes = sum(map(len, keys)) + sum(len(v) for v in res if v is not default)
+			return res
+		finally:
+			self.metrics.record("get_many", time.perf_counter_ns() - start, nbytes)
+
+	def _counted(self, items, sizes):
+		for k, v in items:
+			sizes[0] += len(k) + len(v)
+			yield k, v
+
+	def put_many(self, txn, dbi, items, flags):
+		start, sizes = time.perf_counter_ns(), [0]
+		try:
+			count = self.lib.put_many(txn, dbi, self._counted(items, sizes), flags)
+			self._write(txn, count, sizes[0])
+			return count
+		finally:
+			self.metrics.record("put_many", time.perf_counter_ns() - start, sizes[0])
+
+	def delete_many(self, txn, dbi, keys):
+		keys = list(keys)
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			count = self.lib.delete_many(txn, dbi, keys)
+			nbytes = sum(map(len, keys))
+			self._write(txn, count, nbytes)
+			return count
+		finally:
+			self.metrics.record("delete_many", time.perf_counter_ns() - start, nbytes)
+
+	def get_rows(self, txn, dbi, keys, address, row_size):
+		keys = list(keys)
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			missing = self.lib.get_rows(txn, dbi, keys, address, row_size)
+			nbytes = (len(keys) - len(missing)) * row_size
+			return missing
+		finally:
+			self.metrics.record("get_rows", time.perf_counter_ns() - start, nbytes)
+
+	def put_rows(self, txn, dbi, keys, address, row_size, flags):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			count = self.lib.put_rows(txn, dbi, keys, address, row_size, flags)
+			nbytes = count * row_size
+			self._write(txn, count, nbytes)
+			return count
+		finally:
+			self.metrics.record("put_rows", time.perf_counter_ns() - start, nbytes)
+
+	def cursor_open(self, txn, dbi):
+		cursor = self.lib.cursor_open(txn, dbi)
+		self._cursors[_key(cursor)] = txn
+		return cursor
+
+	def cursor_renew(self, txn, cursor):
+		self.lib.cursor_renew(txn, cursor)
+		self._cursors[_key(cursor)] = txn
+
+	def cursor_close(self, cursor):
+		self._cursors.pop(_key(cursor), None)
+		self.lib.cursor_close(cursor)
+
+	def cursor_get(self, cursor, key, data, op):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			res = self.lib.cursor_get(cursor, key, data, op)
+			nbytes = key.mv_size + data.mv_size
+			return res
+		finally:
+			self.metrics.record("cursor_get", time.perf_counter_ns() - start, nbytes)
+
+	def cursor_get_many(self, cursor, op, count, keys=True, values=True,
+			buffers=False):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			res = self.lib.cursor_get_many(cursor, op, count, keys, values, buffers)
+			if keys and values:
+				nbytes = sum(len(k) + len(v) for k, v in res)
+			else:
+				nbytes = sum(map(len, res))
+			return res
+		finally:
+			self.metrics.record("cursor_get_many", time.perf_counter_ns() - start,
+				nbytes)
+
+	def cursor_put(self, cursor, key, data, flags):
+		start, nbytes = time.perf_counter_ns(), 0
+		try:
+			self.lib.cursor_put(cursor, key, data, flags)
+			nbytes = _size(key) + _size(data)
+			writes = data[1].mv_size if isinstance(data, ctypes.Array) else 1
+			self._write(self._cursors.get(_key(cursor)), writes, nbytes)
+		finally:
+			self.metrics.record("cursor_put", time.perf_counter_ns() - start, nbytes)
+
+	def cursor_put_many(self, cursor, items, flags):
+		start, sizes = time.perf_counter_ns(), [0]
+		try:
+			count = self.lib.cursor_put_many(cursor, self._counted(items, sizes),
+				flags)
+			self._write(self._cursors.get(_key(cursor)), count, sizes[0])
+			return count
+		finally:
+			self.metrics.record("cursor_put_many", time.perf_counter_ns() - start,
+				sizes[0])
+
+	def cursor_del(self, cursor, flags):
+		start = time.perf_counter_ns()
+		try:
+			self.lib.cursor_del(cursor, flags)
+			self._write(self._cursors.get(_key(cursor)), 1, 0)
+		finally:
+			self.metrics.record("cursor_del", time.perf_counter_ns() - start)
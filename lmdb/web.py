@@ -1,18 +1,107 @@
 # coding: utf-8
 
+import base64
+import itertools
 import json
-import random
 import os
 import os.path
+import struct
+import threading
+import time
 
 import bottle
 import werkzeug.http
 
 import lmdb.lmdb as lmdb
+from lmdb.metrics import Metrics
+
+class RequestMetricsPlugin(object):
+	"""Bottle plugin which records the latency of every request by method and
+	route in a Metrics instance, and counts the responses by status."""
+
+	name = "request_metrics"
+	api = 2
+
+	def __init__(self, metrics=None):
+		self.metrics = Metrics() if metrics is None else metrics
+		self.statuses = {}
+		self._lock = threading.Lock()
+
+	def apply(self, callback, route):
+		op = (route.method, route.rule)
+		def wrapper(*args, **kwargs):
+			start = time.perf_counter_ns()
+			status = 500
+			try:
+				res = callback(*args, **kwargs)
+				status = bottle.response.status_code
+				return res
+			except bottle.HTTPResponse as e:
+				status = e.status_code
+				raise
+			finally:
+				self.metrics.record(op, time.perf_counter_ns() - start)
+				key = op + (status,)
+				with self._lock:
+					self.statuses[key] = self.statuses.get(key, 0) + 1
+		return wrapper
+
+def _prometheus_labels(**labels):
+	return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\")
+		.replace('"', '\\"').replace("\n", "\\n"))
+		for k, v in sorted(labels.items())) + "}"
+
+def _prometheus_histogram(lines, name, hist, **labels):
+	"""Append samples of a Histogram snapshot to lines in the Prometheus text
+	format, with cumulative buckets."""
+	total = 0
+	for bound, count in hist["buckets"]:
+		total += count
+		lines.append("{}_bucket{} {}".format(name, _prometheus_labels(le="+Inf"
+			if bound == float("inf") else repr(bound), **labels), total))
+	lines.append("{}_sum{} {}".format(name, _prometheus_labels(**labels),
+		repr(float(hist["sum"]))))
+	lines.append("{}_count{} {}".format(name, _prometheus_labels(**labels),
+		hist["count"]))
+
+def _ndjson_field(obj, name, data):
+	if data is None:
+		obj[name] = None
+		return
+	try:
+		obj[name] = data.decode()
+	except UnicodeDecodeError:
+		obj[name + "_base64"] = base64.b64encode(data).decode()
+
+def _ndjson_item(key, value):
+	"""Return item as JSON line. Keys and values which aren't valid UTF-8 are
+	given in base64 as key_base64 and value_base64, missing values as null."""
+	obj = {}
+	_ndjson_field(obj, "key", key)
+	_ndjson_field(obj, "value", value)
+	return json.dumps(obj).encode() + b"\n"
+
+_length = struct.Struct(">I")
+_MISSING = _length.pack(0xFFFFFFFF)
+
+def _binary_item(key, value):
+	"""Return item as 32 bit big-endian length and bytes of the key followed by
+	the same for the value. Missing values have the length 0xFFFFFFFF."""
+	if value is None:
+		return b"".join((_length.pack(len(key)), key, _MISSING))
+	return b"".join((_length.pack(len(key)), key, _length.pack(len(value)),
+		value))
 
 class Application(bottle.Bottle):
 	VERSION = "0.1"
 	NAMES = {"Apple", "Pear", "Cucumber", "Pineapple"}
+	METRICS_TTL = 1.0
+	STREAM_FORMATS = {
+		"ndjson": ("application/x-ndjson", _ndjson_item),
+		"binary": ("application/octet-stream", _binary_item)
+	}
+	STREAM_CHUNK_SIZE = 65536
+	MAX_BATCH_KEYS = 10000
 
 	request = bottle.request
 	response = bottle.response
@@ -20,9 +109,13 @@ class Application(bottle.Bottle):
 	def __init__(self, *args, **kwargs):
 		environment = kwargs.pop("environment", None)
 		name = kwargs.pop("name", None)
+		instrument = kwargs.pop("instrument", False)
+		group_commit = kwargs.pop("group_commit", True)
+		write_delay = kwargs.pop("write_delay", 0.0)
+		write_batch = kwargs.pop("write_batch", 1000)
 
 		if environment is None:
-			self.environment = lmdb.Environment(lmdb.LibLMDB())
+			self.environment = lmdb.Environment(lmdb.lib)
 			self.environment.open(kwargs.pop("path", "./"))
 		else:
 			self.environment = environment
@@ -32,8 +125,29 @@ class Application(bottle.Bottle):
 		else:
 			self.name = name
 
+		if group_commit:
+			self.writer = self.environment.writer(write_delay, write_batch)
+		else:
+			self.writer = None
+
 		bottle.Bottle.__init__(self, *args, **kwargs)
 
+		# Record the LibLMDB operations of the environment for the metrics
+		# endpoint if asked to, unless it is instrumented already.
+		if instrument and self.environment.metrics is None:
+			self.environment.instrument()
+		self.request_metrics = RequestMetricsPlugin()
+		self.install(self.request_metrics)
+		# Expiry time and body of the last rendered metrics. Bottle doesn't allow
+		# attributes to be reassigned, so it is updated in place.
+		self._metrics_cache = [0, None]
+		self._metrics_lock = threading.Lock()
+
+		# Control routes share one reserved prefix, which hides only keys starting
+		# with "_lmdb/" from the key routes.
+		self.route("/_lmdb/metrics", "GET", self.handle_metrics)
+		self.route("/_lmdb/batch", ["GET", "POST"], self.handle_batch_get)
+		self.route("/_lmdb/scan", "GET", self.handle_scan)
 		self.route("/", "GET", self.handle_index)
 		self.route("/", "TRANSACTION", self.handle_transaction)
 
@@ -78,6 +192,222 @@ class Application(bottle.Bottle):
 			}
 		})
 
+	def handle_metrics(self):
+		"""Return metrics in the Prometheus text format. The output is rendered at
+		most once per METRICS_TTL seconds, and served from a cache otherwise."""
+		self.response.content_type = "text/plain; version=0.0.4; charset=utf-8"
+		with self._metrics_lock:
+			expires, body = self._metrics_cache
+			now = time.monotonic()
+			if body is None or now >= expires:
+				body = self._render_metrics().encode()
+				self._metrics_cache[:] = now + self.METRICS_TTL, body
+		return body
+
+	def _render_metrics(self):
+		stat = self.environment.stat
+		envinfo = self.environment.info
+		used = (envinfo.me_last_pgno + 1) * stat.ms_psize
+		lines = []
+		def gauge(name, help, value):
+			lines.append("# HELP {} {}".format(name, help))
+			lines.append("# TYPE {} gauge".format(name))
+			lines.append("{} {}".format(name, value))
+		gauge("lmdb_page_size_bytes", "Size of a database page.", stat.ms_psize)
+		gauge("lmdb_tree_depth", "Depth of the B-tree of the main database.",
+			stat.ms_depth)
+		gauge("lmdb_branch_pages", "Number of internal pages.", stat.ms_branch_pages)
+		gauge("lmdb_leaf_pages", "Number of leaf pages.", stat.ms_leaf_pages)
+		gauge("lmdb_overflow_pages", "Number of overflow pages.",
+			stat.ms_overflow_pages)
+		gauge("lmdb_entries", "Number of items in the main database.",
+			stat.ms_entries)
+		gauge("lmdb_map_size_bytes", "Size of the memory map.", envinfo.me_mapsize)
+		gauge("lmdb_map_used_bytes", "Size of the used pages of the memory map.",
+			used)
+		gauge("lmdb_map_fill_ratio", "Fraction of the memory map in use.",
+			used / envinfo.me_mapsize)
+		gauge("lmdb_last_txnid", "ID of the last committed transaction.",
+			envinfo.me_last_txnid)
+		gauge("lmdb_readers_max", "Number of reader slots.", envinfo.me_maxreaders)
+		# me_numreaders is the highest slot ever used, so the slots which are
+		# taken now are counted from the reader table.
+		readers = len(self.environment.readers)
+		gauge("lmdb_readers_used", "Number of reader slots in use.", readers)
+		gauge("lmdb_readers_fill_ratio", "Fraction of the reader slots in use.",
+			readers / envinfo.me_maxreaders)
+		gauge("lmdb_readers_high_water", "Highest number of reader slots used "
+			"since the environment was created.", envinfo.me_numreaders)
+
+		plugin = self.request_metrics
+		requests = plugin.metrics.snapshot()["ops"]
+		lines.append("# HELP lmdb_web_request_duration_seconds Latency of requests.")
+		lines.append("# TYPE lmdb_web_request_duration_seconds histogram")
+		for (method, route), op in sorted(requests.items()):
+			_prometheus_histogram(lines, "lmdb_web_request_duration_seconds",
+				{"buckets": op["latency"], "sum": op["seconds"], "count": op["count"]},
+				method=method, route=route)
+		lines.append("# HELP lmdb_web_requests_total Number of responses by status.")
+		lines.append("# TYPE lmdb_web_requests_total counter")
+		with plugin._lock:
+			statuses = sorted(plugin.statuses.items())
+		for (method, route, status), count in statuses:
+			lines.append("lmdb_web_requests_total{} {}".format(_prometheus_labels(
+				method=method, route=route, status=status), count))
+
+		metrics = self.environment.metrics
+		if metrics is not None:
+			self._render_environment_metrics(lines, metrics.snapshot())
+		lines.append("")
+		return "\n".join(lines)
+
+	def _render_environment_metrics(self, lines, snapshot):
+		ops = snapshot["ops"]
+		lines.append("# HELP lmdb_transactions_total Number of transactions begun, "
+			"committed and aborted.")
+		lines.append("# TYPE lmdb_transactions_total counter")
+		for result, names in (("begin", ("txn_begin", "txn_renew")),
+				("commit", ("txn_commit",)), ("abort", ("txn_abort",))):
+			lines.append("lmdb_transactions_total{} {}".format(
+				_prometheus_labels(result=result),
+				sum(ops[name]["count"] for name in names if name in ops)))
+		lines.append("# HELP lmdb_operation_duration_seconds Latency of LibLMDB "
+			"operations.")
+		lines.append("# TYPE lmdb_operation_duration_seconds histogram")
+		for name, op in sorted(ops.items()):
+			_prometheus_histogram(lines, "lmdb_operation_duration_seconds",
+				{"buckets": op["latency"], "sum": op["seconds"], "count": op["count"]},
+				op=name)
+		lines.append("# HELP lmdb_operation_bytes_total Bytes of keys and values "
+			"transferred by LibLMDB operations.")
+		lines.append("# TYPE lmdb_operation_bytes_total counter")
+		for name, op in sorted(ops.items()):
+			lines.append("lmdb_operation_bytes_total{} {}".format(
+				_prometheus_labels(op=name), op["bytes"]))
+		commits = snapshot["commits"]
+		lines.append("# HELP lmdb_commit_writes Number of writes per committed "
+			"write transaction.")
+		lines.append("# TYPE lmdb_commit_writes histogram")
+		_prometheus_histogram(lines, "lmdb_commit_writes", commits["writes"])
+		lines.append("# HELP lmdb_commit_bytes Bytes written per committed write "
+			"transaction.")
+		lines.append("# TYPE lmdb_commit_bytes histogram")
+		_prometheus_histogram(lines, "lmdb_commit_bytes", commits["bytes"])
+
+	def _stream_format(self):
+		"""Return content type and item encoder for the format query parameter, or
+		binary if the client prefers application/octet-stream, else NDJSON."""
+		fmt = self.request.query.get("format")
+		if fmt is None:
+			fmt = "ndjson"
+			if "Accept" in self.request.headers:
+				accepted = werkzeug.http.parse_accept_header(self.request.headers["Accept"])
+				if accepted.best_match(["application/x-ndjson",
+						"application/octet-stream"]) == "application/octet-stream":
+					fmt = "binary"
+		return self.STREAM_FORMATS.get(fmt)
+
+	def _raw_database(self, txn):
+		"""Return the main database of txn without codecs, whose keys and values
+		are bytes copies that stay valid after the transaction."""
+		return txn.database(key_codec=lmdb.RawCodec(), value_codec=lmdb.RawCodec())
+
+	def _stream(self, items, encode):
+		"""Encode items and yield them in chunks of about STREAM_CHUNK_SIZE bytes."""
+		chunk, size = [], 0
+		for key, value in items:
+			data = encode(key, value)
+			chunk.append(data)
+			size += len(data)
+			if size >= self.STREAM_CHUNK_SIZE:
+				yield b"".join(chunk)
+				chunk, size = [], 0
+		if chunk:
+			yield b"".join(chunk)
+
+	def _invalid_request(self, msg):
+		self.response.content_type = "application/json"
+		self.response.status = 400
+		return json.dumps({
+			"message": "exception",
+			"exception": "invalid",
+			"msg": msg
+		})
+
+	def handle_batch_get(self):
+		"""Return the items for keys in the body {"keys": [...]} of a POST request or
+		the key query parameters of a GET request, read in one transaction."""
+		stream_format = self._stream_format()
+		if stream_format is None:
+			return self._invalid_request("unknown format")
+		if self.request.method == "POST":
+			try:
+				keys = json.loads(self.request.body.read().decode())["keys"]
+			except (ValueError, KeyError, TypeError):
+				return self._invalid_request("expected {\"keys\": [...]}")
+		else:
+			keys = self.request.query.getall("key")
+		if not isinstance(keys, list) or \
+				not all(isinstance(key, str) for key in keys):
+			return self._invalid_request("keys must be a list of strings")
+		if len(keys) > self.MAX_BATCH_KEYS:
+			return self._invalid_request("more than {} keys".format(
+				self.MAX_BATCH_KEYS))
+		keys = [key.encode() for key in keys]
+		try:
+			with self.environment.begin(lmdb.MDB_RDONLY) as txn:
+				values = self._raw_database(txn).get_many(keys, buffers=False)
+		except lmdb.Error as err:
+			self.response.content_type = "application/json"
+			self.response.status = 500
+			return json.dumps(self._lmdb_error_to_json(err, None))
+		content_type, encode = stream_format
+		self.response.content_type = content_type
+		return self._stream(zip(keys, values), encode)
+
+	def handle_scan(self):
+		"""Stream the items with keys starting with the prefix query parameter, or
+		between start (inclusive) and stop (exclusive), in chunked responses. A
+		single read transaction and cursor are held until the response ends."""
+		stream_format = self._stream_format()
+		if stream_format is None:
+			return self._invalid_request("unknown format")
+		query = self.request.query
+		reverse = query.get("reverse", "") in ("1", "true")
+		try:
+			limit = int(query["limit"]) if "limit" in query else None
+		except ValueError:
+			limit = -1
+		if limit is not None and limit < 0:
+			return self._invalid_request("limit must be a non-negative integer")
+		def scan():
+			with self.environment.begin(lmdb.MDB_RDONLY) as txn:
+				db = self._raw_database(txn)
+				if "prefix" in query:
+					items = db.iter_prefix(query["prefix"].encode(), reverse,
+						buffers=False)
+				else:
+					start, stop = (None if bound is None else bound.encode()
+						for bound in (query.get("start"), query.get("stop")))
+					items = db.iter_range(start, stop, reverse, buffers=False)
+				yield from self._stream(itertools.islice(items, limit), encode)
+		content_type, encode = stream_format
+		chunks = scan()
+		# The first chunk is read here, so that errors on opening the transaction
+		# still produce an error response.
+		try:
+			first = next(chunks, b"")
+		except lmdb.Error as err:
+			self.response.content_type = "application/json"
+			self.response.status = 500
+			return json.dumps(self._lmdb_error_to_json(err, None))
+		self.response.content_type = content_type
+		def stream():
+			# Closing this generator closes the scan and its transaction.
+			yield first
+			yield from chunks
+		return stream()
+
 	def handle_get(self, key):
 		self.response.content_type = "application/json"
 		try:
@@ -92,11 +422,21 @@ class Application(bottle.Bottle):
 		self.response.content_type = self._pick_type()
 		return data
 
+	def _write(self, func):
+		"""Call func with a write transaction, which is shared with concurrent
+		requests if group commit is enabled, and return its result after the
+		commit."""
+		if self.writer is None:
+			return self.environment.run(func)
+		return self.writer.submit(func).result()
+
 	def handle_set(self, key):
 		self.response.content_type = "application/json"
+		value = self.request.body.read()
+		def put(txn):
+			txn[key] = value
 		try:
-			with self.environment.begin() as txn:
-				txn[key] = self.request.body.read()
+			self._write(put)
 		except lmdb.Error as err:
 			self.response.status = 500
 			return json.dumps(self._lmdb_error_to_json(err, key))
@@ -108,9 +448,10 @@ class Application(bottle.Bottle):
 
 	def handle_delete(self, key):
 		self.response.content_type = "application/json"
+		def delete(txn):
+			del txn[key]
 		try:
-			with self.environment.begin() as txn:
-				del txn[key]
+			self._write(delete)
 		except lmdb.Error as err:
 			self.response.status = 500
 			return json.dumps(self._lmdb_error_to_json(err, key))
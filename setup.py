@@ -23,8 +23,10 @@ setuptools.setup(
 	classifiers=[
 		"Development Status :: 4 - Beta",
 		"Operating System :: POSIX",
-		"Programming Language :: Python :: 3.3",
+		"Programming Language :: Python :: 3 :: Only",
+		"Programming Language :: Python :: 3.8",
 		"Topic :: Database :: Database Engines/Servers"
 	],
-	long_description=long_description
+	long_description=long_description,
+	python_requires=">=3.8"
 )
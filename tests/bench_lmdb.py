@@ -0,0 +1,30 @@
+# coding: utf-8
+"""The cases of lmdb.bench as pytest-benchmark tests. This module doesn't match
+the default test file pattern, so it only runs when given explicitly:
+
+	$ python -m pytest tests/bench_lmdb.py --benchmark-only
+	$ python -m pytest tests/bench_lmdb.py --benchmark-only -k "txn_get and 1024"
+"""
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import lmdb.lmdb as lmdb
+from lmdb.bench import CASES, case_name
+
+@pytest.fixture
+def env(tmp_path):
+	env = lmdb.Environment(lmdb.lib, str(tmp_path))
+	env.set_mapsize(1 << 30)
+	yield env
+	env.close()
+
+@pytest.mark.parametrize("name,func,params", CASES,
+	ids=[case_name(name, params) for name, func, params in CASES])
+def test_bench(benchmark, env, name, func, params):
+	benchmark.group = name
+	try:
+		func(benchmark, env, **params)
+	except ImportError as e:
+		pytest.skip(str(e))